@@ -0,0 +1,130 @@
+# coding: utf-8
+# Compares the songs cache formats: a pickled dictionary (the former cache)
+# and the TagStore, on a synthetic library. Every measure runs in a new
+# process, so that the load time and the peak RSS are those of a command.
+#
+#   python benchmarks/cache_load.py [number of songs]
+
+import os
+import sys
+import pickle
+import random
+import tempfile
+import subprocess
+import collections
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from mpdc.libs.tagstore import TagStoreWriter
+
+
+def library(size):
+    random.seed(0)
+    songs = collections.OrderedDict()
+    genres = ['Rock', 'Jazz', 'Electronic', 'Classical', 'Pop', 'Metal']
+    for album_id in range(size // 10 + 1):
+        artist = 'Artist {}'.format(album_id // 4)
+        album = 'Album {}'.format(album_id)
+        date = str(random.randint(1960, 2013))
+        genre = random.choice(genres)
+        for track in range(1, 11):
+            filename = '{}/{}/{:02} - Title {}.flac'.format(artist, album,
+                                                            track, track)
+            songs[filename] = {
+                'artist': artist, 'albumartist': artist, 'album': album,
+                'title': 'Title {} of {}'.format(track, album),
+                'track': str(track), 'date': date, 'genre': genre,
+                'time': str(random.randint(60, 600)),
+                'duration': '{:.3f}'.format(random.uniform(60, 600)),
+                'last-modified': '2013-01-{:02}T12:00:00Z'.format(track),
+            }
+            if len(songs) == size:
+                return songs
+    return songs
+
+
+# code run in the measuring processes, after the imports
+scenarios = {
+    'pickle: load': '''
+with open(path, 'rb') as f:
+    songs = pickle.load(f)
+''',
+    'pickle: load, artist of every song': '''
+with open(path, 'rb') as f:
+    songs = pickle.load(f)
+artists = [song.get('artist') for song in songs.values()]
+''',
+    'store: open': '''
+songs = TagStore.open(path)
+''',
+    'store: open, list of files': '''
+songs = TagStore.open(path)
+files = songs.get_files()
+''',
+    'store: open, artist of every song': '''
+songs = TagStore.open(path)
+artists = [[songs.string(i) for i in songs.value_ids(row, 'artist')]
+           for row in range(len(songs))]
+''',
+}
+
+# peak RSS (VmHWM, in KiB) is read from /proc, Linux only: ru_maxrss of a
+# child process starts from the peak of its parent
+measure = '''
+import sys, time, pickle
+sys.path.insert(0, {root!r})
+from mpdc.libs.tagstore import TagStore
+def peak():
+    with open('/proc/self/status') as f:
+        return int(f.read().split('VmHWM:')[1].split()[0])
+path = {path!r}
+rss = peak()
+start = time.perf_counter()
+{code}
+elapsed = time.perf_counter() - start
+print(elapsed, peak() - rss)
+'''
+
+
+def run(code, path, repeat=5):
+    root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+    results = []
+    for i in range(repeat):
+        output = subprocess.check_output(
+            [sys.executable, '-c', measure.format(root=root, path=path,
+                                                  code=code)])
+        elapsed, rss = output.split()
+        results.append((float(elapsed), int(rss)))
+    return min(results)
+
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    songs = library(size)
+    directory = tempfile.mkdtemp()
+    paths = {'pickle': os.path.join(directory, 'songs_info.pickle'),
+             'store': os.path.join(directory, 'songs_info.store')}
+    with open(paths['pickle'], 'wb') as f:
+        pickle.dump(songs, f)
+    writer = TagStoreWriter()
+    for filename, song in songs.items():
+        writer.add(filename, song)
+    with open(paths['store'], 'wb') as f:
+        f.write(writer.to_bytes())
+
+    print('{} songs'.format(len(songs)))
+    for name, path in sorted(paths.items()):
+        print('{:8} {:>8.1f} MiB'.format(name, os.path.getsize(path) / 2**20))
+    print()
+    print('{:40} {:>10} {:>12}'.format('', 'time (ms)', 'RSS (MiB)'))
+    for name, code in scenarios.items():
+        elapsed, rss = run(code, paths[name.split(':')[0]])
+        print('{:40} {:>10.1f} {:>12.1f}'.format(name, elapsed * 1000,
+                                                 rss / 1024))
+    for path in paths.values():
+        os.unlink(path)
+    os.rmdir(directory)
+
+
+if __name__ == '__main__':
+    main()
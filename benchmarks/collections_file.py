@@ -0,0 +1,126 @@
+# coding: utf-8
+# Reading and writing a collections file of 50,000 songs (500 collections of
+# 100 songs) on a synthetic library of 100,000 songs. mpdc.initialize is
+# replaced by a stub: the songs are found in a TagStore, MPD is not asked.
+# First checks that a collection added after a hand-edited last section
+# stays a section of its own.
+#
+#   python benchmarks/collections_file.py [number of songs in the file]
+
+import os
+import sys
+import time
+import types
+import random
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from cache_load import library
+from mpdc.libs.utils import Cache, repr_tags
+
+directory = tempfile.mkdtemp()
+Cache.cache_path = os.path.join(directory, '{profile}', '{name}.mpdc')
+initialize = types.ModuleType('mpdc.initialize')
+initialize.cache = Cache(1)
+sys.modules['mpdc.initialize'] = initialize
+
+from mpdc.libs.tagstore import TagStore, TagStoreWriter
+from mpdc.libs.mpdhelper import MPDHelper
+
+initialize.mpd = mpd = MPDHelper('localhost', '', 6600)
+mpd.get_stored_playlists_info = lambda: []
+
+from mpdc.libs.collectionsmanager import CollectionsManager
+
+
+# the former optimized_to_raw, for comparison
+def former_optimized_to_raw(collections_optimized):
+    raw = ''
+    for alias, collection in collections_optimized.items():
+        raw += '--' + alias
+        if 'songs' in collection and collection['songs']:
+            raw += '\nsongs:'
+            for song in collection['songs']:
+                raw += '\n    ' + repr_tags(mpd.get_tags(song))
+        raw += '\n\n\n'
+    return raw.strip()
+
+
+def measure(name, function, repeat=3):
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    print('{:45} {:>10.1f}'.format(name, min(times) * 1000))
+
+
+def check_added_after_last_section(path, song):
+    # the last section has no blank line after it
+    with open(path, 'w') as f:
+        f.write('--rnd\nall |r2\n')
+    manager = initialize.collectionsmanager = CollectionsManager(path)
+    manager.feed(force=True)
+    manager.add_songs('foo2', [song])
+    manager.write_file()
+    with open(path) as f:
+        raw = f.read()
+    assert raw == ('--rnd\nall |r2\n\n\n--foo2\nsongs:\n    ' +
+                   repr_tags(mpd.get_tags(song)) + '\n\n\n'), raw
+    manager.feed(force=True)
+    assert list(manager.c) == ['rnd', 'foo2'], list(manager.c)
+    assert manager.c['foo2']['songs'] == [song]
+
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    songs = library(100000)
+    writer = TagStoreWriter()
+    for filename, song in songs.items():
+        writer.add(filename, song)
+    initialize.cache.write_bytes('songs_info', writer.to_bytes())
+    mpd.all_songs_tags = TagStore.open(Cache.cache_path.format(
+                                       profile=1, name='songs_info'))
+
+    path = os.path.join(directory, 'collections')
+    check_added_after_last_section(path, next(iter(songs)))
+
+    random.seed(0)
+    with open(path, 'w') as f:
+        files = random.sample(list(songs), size)
+        for start in range(0, size, 100):
+            f.write('--collection{}\nsongs:\n'.format(start // 100))
+            for song in files[start:start + 100]:
+                f.write('    ' + repr_tags(mpd.get_tags(song)) + '\n')
+            f.write('\n\n')
+    print('{} songs in {} collections, {:.1f} MiB'.format(
+          size, (size + 99) // 100, os.path.getsize(path) / 2**20))
+    print()
+    print('{:45} {:>10}'.format('', 'time (ms)'))
+
+    manager = initialize.collectionsmanager = CollectionsManager(path)
+    measure('read, whole file',
+            lambda: manager.feed(force=True, incremental=False))
+    manager.update_cache()
+    measure('read, unchanged file', lambda: manager.feed(force=True))
+
+    measure('former optimized_to_raw, whole file',
+            lambda: former_optimized_to_raw(manager.c))
+
+    def write_all():
+        manager.changed.update(manager.c)
+        manager.write_file()
+    measure('write, every collection changed', write_all)
+
+    def write_one():
+        manager.changed.add('collection0')
+        manager.write_file()
+    measure('write, one collection changed', write_one)
+
+    shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,42 @@
+# coding: utf-8
+# Time of "import mpdc.libs.parser" in a new process. mpdc.initialize, which
+# reads the configuration and connects to MPD, is replaced by a stub so that
+# only the parser module itself is measured.
+#
+#   python benchmarks/parser_import.py [number of runs]
+
+import os
+import sys
+import statistics
+import subprocess
+
+measure = '''
+import sys, time, types
+sys.path.insert(0, {root!r})
+initialize = types.ModuleType('mpdc.initialize')
+for name in ('mpd', 'collectionsmanager', 'lastfm', 'cache'):
+    setattr(initialize, name, None)
+initialize.enable_command = False
+sys.modules['mpdc.initialize'] = initialize
+import mpdc.libs.utils
+start = time.perf_counter()
+import mpdc.libs.parser
+print(time.perf_counter() - start)
+'''
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+    times = []
+    for i in range(runs):
+        output = subprocess.check_output(
+            [sys.executable, '-c', measure.format(root=root)])
+        times.append(float(output) * 1000)
+    print('import mpdc.libs.parser, {} runs'.format(runs))
+    print('min {:.2f} ms, median {:.2f} ms, max {:.2f} ms'.format(
+          min(times), statistics.median(times), max(times)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+# coding: utf-8
+# Checks the commands planned by queue_edits (used by "mpdc replace" and
+# "mpdc keep") on random queues: applied to a simulated queue they must give
+# the wanted songs, keep the current song when it stays, and only delete
+# entries when the wanted songs are a subsequence of the queue. Then times
+# the planning on a queue of 20,000 songs. mpdc.initialize is replaced by a
+# stub, MPD is not asked.
+#
+#   python benchmarks/queue_edits.py [number of random queues]
+
+import os
+import sys
+import time
+import types
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+initialize = types.ModuleType('mpdc.initialize')
+initialize.cache = None
+sys.modules['mpdc.initialize'] = initialize
+
+from mpdc.libs.mpdhelper import queue_edits
+
+
+def playlistinfo(queue):
+    return [{'id': song_id, 'file': song_file, 'pos': str(position)}
+            for position, (song_id, song_file) in enumerate(queue)]
+
+
+def apply(queue, commands):
+    # (id, file) of the entries of the queue once the commands are run
+    queue = list(queue)
+    next_id = len(queue)
+    for command in commands:
+        if command[0] == 'deleteid':
+            queue = [entry for entry in queue if entry[0] != command[1]]
+        elif command[0] == 'addid':
+            assert 0 <= command[2] <= len(queue), command
+            next_id += 1
+            queue.insert(command[2], ('added{}'.format(next_id), command[1]))
+        elif command[0] == 'moveid':
+            entry = next(entry for entry in queue if entry[0] == command[1])
+            queue.remove(entry)
+            assert 0 <= command[2] <= len(queue), command
+            queue.insert(command[2], entry)
+    return queue
+
+
+def is_subsequence(songs, queue):
+    files = iter(song_file for _, song_file in queue)
+    return all(song in files for song in songs)
+
+
+def check(queue, current_id, songs):
+    commands = queue_edits(playlistinfo(queue), current_id, songs)
+    result = apply(queue, commands)
+    assert [song_file for _, song_file in result] == songs, \
+        (queue, current_id, songs, commands)
+    current_file = dict(queue).get(current_id)
+    if current_file in songs:
+        assert current_id in dict(result), (queue, current_id, songs)
+        # a cropped queue keeps the current entry, if an entry in order can
+        # be kept for each song
+        if is_subsequence(songs, queue):
+            position = [song_id for song_id, _ in queue].index(current_id)
+            if any(song == current_file and
+                   is_subsequence(songs[:i], queue[:position]) and
+                   is_subsequence(songs[i + 1:], queue[position + 1:])
+                   for i, song in enumerate(songs)):
+                assert all(command[0] == 'deleteid' for command in commands)
+    elif is_subsequence(songs, queue):
+        assert all(command[0] == 'deleteid' for command in commands), \
+            (queue, current_id, songs, commands)
+
+
+def main():
+    trials = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    random.seed(0)
+    for trial in range(trials):
+        pool = ['f{}'.format(i) for i in range(random.randint(1, 12))]
+        queue = [(str(i), random.choice(pool))
+                 for i in range(random.randint(0, 12))]
+        current_id = None
+        if queue and random.random() < 0.8:
+            current_id = random.choice(queue)[0]
+        if random.random() < 0.3:
+            # a cropped queue
+            songs = [song_file for _, song_file in queue
+                     if random.random() < 0.6]
+        else:
+            songs = [random.choice(pool)
+                     for i in range(random.randint(0, 12))]
+        check(queue, current_id, songs)
+    # the current song, a duplicate, stays in place
+    queue = [('0', 'x'), ('1', 'y'), ('2', 'x')]
+    assert queue_edits(playlistinfo(queue), '2', ['x', 'x']) == \
+        [('deleteid', '1')]
+    print('{} random queues checked'.format(trials))
+
+    size = 20000
+    queue = [(str(i), 'f{}'.format(i)) for i in range(size)]
+    files = [song_file for _, song_file in queue]
+    cases = [('reversed', files[::-1]),
+             ('shuffled', random.sample(files, size)),
+             ('one song in two', files[::2])]
+    print()
+    print('{:45} {:>10}'.format('', 'time (ms)'))
+    for name, songs in cases:
+        start = time.perf_counter()
+        queue_edits(playlistinfo(queue), '3', songs)
+        print('{:45} {:>10.1f}'.format('{}, {} songs'.format(name, size),
+                                       (time.perf_counter() - start) * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -2,6 +2,7 @@
 import os
 import sys
 import atexit
+import threading
 from configparser import ConfigParser
 
 from mpdc.libs.utils import Cache, warning, colors_c, columns_w
@@ -65,6 +66,12 @@ cache = Cache(profile)
 # --------------------------------
 
 from mpdc.libs.mpdhelper import MPDHelper
+from mpdc.libs.watcher import IdleWatcher
+if 'batch_size' in config['mpdc']:
+    MPDHelper.batch_size = max(1, int(config['mpdc']['batch_size']))
+
+MPDHelper.local_queries = config['mpdc'].get('local_queries', 'y') == 'y'
+
 mpd = MPDHelper(profiles[profile]['host'],
                 profiles[profile]['password'],
                 profiles[profile]['port'])
@@ -73,9 +80,15 @@ if not mpd.connect():
     warning('Unable to connect to the MPD server')
     sys.exit(0)
 
-if (not cache.exists('songs_tags') or
-    cache.last_modified('songs_tags') < int(mpd.stats()['db_update'])):
-    mpd.update_cache()
+
+def refresh_database():
+    # under the lock, a concurrent mpdc may have just updated the cache
+    with cache.lock():
+        if (not cache.exists('songs_info') or
+            cache.last_modified('songs_info') < int(mpd.stats()['db_update'])):
+            mpd.update_cache()
+
+refresh_database()
 
 
 # --------------------------------
@@ -92,19 +105,28 @@ except IOError:
 from mpdc.libs.collectionsmanager import CollectionsManager
 collectionsmanager = CollectionsManager(c_path)
 
-update_collections = False
 
-if (not cache.exists('playlists') or cache.read('playlists') !=
-    mpd.get_stored_playlists_info()):
-    cache.write('playlists', mpd.get_stored_playlists_info())
-    update_collections = True
+def refresh_collections(playlists_changed=None):
+    # playlists_changed is None when MPD has to be asked
+    update_collections = False
+
+    with cache.lock():
+        if playlists_changed is None:
+            playlists_changed = (not cache.exists('playlists') or
+                                 cache.read('playlists') !=
+                                 mpd.get_stored_playlists_info())
+        if playlists_changed:
+            cache.write('playlists', mpd.get_stored_playlists_info())
+            update_collections = True
+
+        if (update_collections or not cache.exists('collections') or
+            cache.last_modified('collections') < os.path.getmtime(c_path)):
+            collectionsmanager.feed(force=True)
+            collectionsmanager.update_cache()
+        else:
+            collectionsmanager.feed()
 
-if (update_collections or not cache.exists('collections')
-    or cache.last_modified('collections') < os.path.getmtime(c_path)):
-    collectionsmanager.feed(force=True)
-    collectionsmanager.update_cache()
-else:
-    collectionsmanager.feed()
+refresh_collections()
 
 atexit.register(collectionsmanager.update)
 
@@ -117,3 +139,61 @@ lastfm = LastfmHelper()
 
 if 'min_similarity' in config['mpdc']:
     LastfmHelper.min_similarity = int(config['mpdc']['min_similarity']) / 100
+
+
+# --------------------------------
+# Refresh (long-running processes)
+# --------------------------------
+
+# the daemon and the idle watcher thread refresh the state with this lock
+lock = threading.RLock()
+
+
+def refresh(changed=None):
+    # changed holds the subsystems reported by an idle watcher, None means
+    # nobody watches and MPD has to be probed
+    with lock:
+        if not mpd.ping():
+            warning('Unable to connect to the MPD server')
+            sys.exit(0)
+        update_state(changed)
+
+
+def refresh_watched(changed):
+    # called by the idle watcher thread, which must not exit the process:
+    # errors are raised to the watcher, which then stops
+    with lock:
+        if not mpd.ping():
+            raise ConnectionError('Unable to connect to the MPD server')
+        update_state(changed)
+
+
+def update_state(changed):
+    with lock:
+        # results of the collections depend on the state of MPD
+        collectionsmanager.generation += 1
+        if changed is None:
+            mpd.invalidate(IdleWatcher.subsystems)
+            refresh_database()
+            refresh_collections()
+        else:
+            mpd.invalidate(changed)
+            if 'database' in changed:
+                mpd.update_cache()
+            # the collections file is not watched by MPD
+            refresh_collections(playlists_changed='stored_playlist' in changed)
+
+
+def stop_watching():
+    # the watcher gave up, MPD is probed again before each command
+    with lock:
+        mpd.watched = False
+        mpd.invalidate(IdleWatcher.subsystems)
+
+
+def watch():
+    watcher = IdleWatcher(mpd.host, mpd.port, mpd.password, refresh_watched,
+                          stop_watching)
+    mpd.watched = True
+    watcher.start()
+    return watcher
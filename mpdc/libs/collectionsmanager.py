@@ -1,142 +1,350 @@
 # coding: utf-8
 import ast
-from collections import OrderedDict
+import hashlib
+from collections import OrderedDict, defaultdict
 
 from mpdc.initialize import mpd, cache
-from mpdc.libs.utils import repr_tags, info, warning
+from mpdc.libs.utils import repr_tags, atomic_write, info, warning
+from mpdc.libs.songset import SongSet, bits_to_ids
 
 
 class CollectionsManager:
 
     def __init__(self, collections_filepath):
         self.path = collections_filepath
-        self.collections = []
+        # read from the cache when first used
+        self.collections = None
         self.need_update = False
+        # aliases of the collections changed since they were read, the other
+        # sections of the file are written again as they are
+        self.changed = set()
+        # what the collections were read from (see raw_to_optimized), None
+        # when they come from the cache
+        self.sources = None
+        # changes when the collections may have changed, results of their
+        # evaluation are dropped
+        self.generation = 0
+        # alias -> (key, songs) of the deterministic collections evaluated
+        # by the parser, read from the cache when first used
+        self.results = None
+        self.results_need_update = False
+        # (signature of the results, song id -> aliases) built from results
+        self.reverse_index = None
+        self.reverse_index_need_update = False
 
     @property
     def c(self):
+        if self.collections is None:
+            if cache.exists('collections'):
+                self.collections = cache.read('collections', default=None)
+            if self.collections is None:
+                self.feed(force=True)
         return self.collections
 
-    def feed(self, force=False):
-        if cache.exists('collections') and not force:
-            self.collections = cache.read('collections')
-        else:
+    def feed(self, force=False, incremental=True):
+        # when incremental, the sections of the file and the MPD playlists
+        # which did not change since the cache was written are not read again
+        if force or not cache.exists('collections'):
+            previous = self.previous_sources() if incremental else None
             with open(self.path, 'r') as f:
-                self.collections = raw_to_optimized(f.readlines())
+                self.collections, self.sources = raw_to_optimized(
+                    f.readlines(), previous)
+            self.changed.clear()
+            self.generation += 1
+
+    def previous_sources(self):
+        # (sources, collections) of the cache, None if they are missing
+        if not (cache.exists('collections') and
+                cache.exists('collections_sources')):
+            return None
+        sources = cache.read('collections_sources', default=None)
+        collections = cache.read('collections', default=None)
+        if sources is None or collections is None:
+            return None
+        return sources, collections
 
     def add_songs(self, alias, songs_files):
-        if not alias in self.c or not 'mpd_playlist' in self.c[alias]:
-            for song in songs_files[:]:
+        # songs already in a collection of the file are not added again, a
+        # MPD playlist may hold duplicates and only receives the added songs
+        collection = self.c.get(alias, {})
+        songs = collection.get('songs', [])
+        if 'mpd_playlist' in collection:
+            added_songs = list(songs_files)
+        else:
+            present = set(songs)
+            added_songs = []
+            for song in songs_files:
+                if song in present:
+                    continue
                 if not all(mpd.get_tags(song)):
                     warning('[{}] was not added (missing tags)'.format(song))
-                    songs_files.remove(song)
-        if alias in self.c:
-            if 'songs' in self.c[alias]:
-                self.collections[alias]['songs'].extend(songs_files)
-            else:
-                self.collections[alias]['songs'] = songs_files
-            if 'mpd_playlist' in self.c[alias]:
-                mpd.add_songs_stored_playlist(alias, songs_files)
-        else:
+                    continue
+                present.add(song)
+                added_songs.append(song)
+        if not added_songs:
+            return
+        if alias not in self.c:
             info('Collection [{}] will be created'.format(alias))
-            self.collections[alias] = {}
-            self.collections[alias]['songs'] = songs_files
+            self.collections[alias] = collection
+        if 'mpd_playlist' in collection:
+            mpd.add_songs_stored_playlist(alias, added_songs)
+        collection['songs'] = songs + added_songs
         self.need_update = True
+        self.changed.add(alias)
+        self.generation += 1
 
     def remove_songs(self, alias, songs_files):
         if alias in self.c and 'songs' in self.c[alias]:
-            remaining_songs = [s for s in self.c[alias]['songs']
-                               if s not in songs_files]
+            removed_songs = set(songs_files)
+            songs = self.c[alias]['songs']
+            remaining_songs = [s for s in songs if s not in removed_songs]
+            if len(remaining_songs) == len(songs):
+                return
             if 'mpd_playlist' in self.c[alias]:
-                mpd.clear_stored_playlist(alias)
-                mpd.add_songs_stored_playlist(alias, remaining_songs)
+                # positions in the playlist as it is now
+                positions = [i for i, song in enumerate(
+                             mpd.get_stored_playlist_songs(alias))
+                             if song in removed_songs]
+                mpd.remove_songs_stored_playlist(alias, positions)
             self.collections[alias]['songs'] = remaining_songs
             self.need_update = True
+            self.changed.add(alias)
+            self.generation += 1
         else:
             warning('Collection [{}] does not exist or contains no song to '
                     'remove'.format(alias))
 
+    def get_results(self):
+        if self.results is None:
+            self.results = {}
+            if cache.exists('collections_results'):
+                self.results = cache.read('collections_results')
+        return self.results
+
+    def get_result(self, alias, key):
+        result = self.get_results().get(alias)
+        if result is None or result[0] != key:
+            return None
+        bits, segments = result[1]
+        return SongSet(mpd.get_song_index(), bits, segments)
+
+    def set_result(self, alias, key, songs):
+        songs = mpd.songset(songs)
+        # only the ids of the songs of the library are stable
+        if songs.bits & ~mpd.get_song_index().library_bits:
+            return
+        self.get_results()[alias] = (key, (songs.bits, songs.segments))
+        self.results_need_update = True
+
+    def get_reverse_index(self):
+        # song id -> aliases of the collections whose result is cached
+        results = self.get_results()
+        signature = sorted((alias, result[0]) for alias, result
+                           in results.items())
+        if self.reverse_index is None or self.reverse_index[0] != signature:
+            if cache.exists('collections_index'):
+                self.reverse_index = cache.read('collections_index',
+                                                default=None)
+            if self.reverse_index is None or \
+               self.reverse_index[0] != signature:
+                songs = defaultdict(list)
+                for alias, (key, (bits, segments)) in results.items():
+                    for song_id in bits_to_ids(bits):
+                        songs[song_id].append(alias)
+                self.reverse_index = (signature, dict(songs))
+                self.reverse_index_need_update = True
+        return self.reverse_index[1]
+
+    def file_changed(self):
+        return any(alias not in self.c or 'mpd_playlist' not in self.c[alias]
+                   for alias in self.changed)
+
     def write_file(self):
-        with open(self.path, 'w') as f:
-            f.write(optimized_to_raw(self.collections))
+        # the file is written section by section to a temporary file, the
+        # sections of the unchanged collections are copied from the file
+        preamble, verbatim = [], {}
+        try:
+            with open(self.path, 'r') as f:
+                lines = f.readlines()
+        except IOError:
+            lines = []
+        for line in lines:
+            if line.startswith('--'):
+                break
+            preamble.append(line.rstrip('\n') + '\n')
+        for section_hash, section_lines in split_sections(lines):
+            alias = section_alias(section_lines[0])
+            if alias not in self.changed:
+                verbatim[alias] = ''.join(section_lines)
+        sections = []
+
+        def chunks():
+            yield ''.join(preamble)
+            for alias, text in optimized_to_raw(self.collections, verbatim):
+                sections.append((hashlib.sha1(text.encode()).hexdigest(),
+                                 alias))
+                yield text
+
+        atomic_write(self.path, chunks())
+        # the songs were found in the library of the last read, if any
+        if self.sources is None and cache.exists('collections_sources'):
+            self.sources = cache.read('collections_sources', default=None)
+        library = self.sources['library'] if self.sources else None
+        self.sources = collections_sources(sections,
+                                           [alias for _, alias in sections],
+                                           mpd.get_stored_playlists_info(),
+                                           library)
+        self.changed.clear()
 
     def update_cache(self):
         cache.write('collections', self.collections)
+        if self.sources is not None:
+            cache.write('collections_sources', self.sources)
 
     def update(self):
         if self.need_update:
-            self.write_file()
-            self.update_cache()
-            cache.write('playlists', mpd.get_stored_playlists_info())
+            with cache.lock():
+                if self.file_changed():
+                    self.write_file()
+                self.update_cache()
+                cache.write('playlists', mpd.get_stored_playlists_info())
+            self.need_update = False
+        if self.results_need_update:
+            self.results = {alias: result for alias, result
+                            in self.results.items() if alias in self.c}
+            cache.write('collections_results', self.results)
+            self.results_need_update = False
+        if self.reverse_index_need_update:
+            cache.write('collections_index', self.reverse_index)
+            self.reverse_index_need_update = False
 
 
-# Human-readable format -> dictionary of collections including MPD playlists
-def raw_to_optimized(collections_raw):
+# Human-readable format -> dictionary of collections including MPD playlists,
+# and the sources they were read from: the hash of the text of each section,
+# the last modification of each MPD playlist and of the songs cache. With the
+# sources and the collections of a previous call, unchanged sections and
+# playlists are reused
+def raw_to_optimized(collections_raw, previous=None):
+    previous_sources, previous_collections = previous or (None, {})
+    library = (cache.last_modified('songs_info')
+               if cache.exists('songs_info') else None)
     collections = OrderedDict()
-    alias = ''
-    for line in collections_raw:
-        if line.startswith('--'):
-            alias = (line[2:] if line[2] not in '@#' else line[3:]).strip()
-            collections[alias] = {}
-            if line[2] == '@':
-                collections[alias]['sort'] = True
-            elif line[2] == '#':
-                collections[alias]['special'] = True
-        elif alias:
-            if line.startswith('command:'):
-                collections[alias]['command'] = line[8:].strip()
-            elif line.startswith('songs:'):
-                collections[alias]['songs'] = []
-            elif line.strip():
-                if ('songs' in collections[alias] and
-                   (line.startswith('    ') or line.startswith('\t'))):
-                    tags = ast.literal_eval('({})'.format(line.strip()))
-                    artist, album, title, track = tags
-                    matched_songs = mpd.find_multiple(artist=artist,
-                                                      album=album,
-                                                      title=title,
-                                                      track=track)
-                    if matched_songs:
-                        collections[alias]['songs'].append(matched_songs[0])
-                    else:
-                        warning('In collection [{}], these tags do not match '
-                                'any song: {}'.format(alias, repr_tags(tags)))
-                else:
-                    if 'expression' not in collections[alias]:
-                        collections[alias]['expression'] = line
-                    else:
-                        collections[alias]['expression'] += line
+    # (songs list, alias, tags) of the songs, found all at once at the end
+    pinned_songs = []
+    sections = split_sections(collections_raw)
+    aliases = []
+    for section_hash, lines in sections:
+        alias = previous_sources and \
+            previous_sources['sections'].get(section_hash)
+        collection = previous_collections.get(alias)
+        # the files of the songs depend on the library
+        if (collection is None or 'mpd_playlist' in collection or
+            'songs' in collection and library != previous_sources['library']):
+            alias, collection = parse_section(lines, pinned_songs)
+        collections[alias] = collection
+        aliases.append(alias)
+    songs_files = mpd.find_songs(tags for _, _, tags in pinned_songs)
+    for (songs, alias, tags), song_file in zip(pinned_songs, songs_files):
+        if song_file is not None:
+            songs.append(song_file)
+        else:
+            warning('In collection [{}], these tags do not match any song: {}'.
+                    format(alias, repr_tags(tags)))
     # add MPD native playlists
-    for playlist in mpd.get_stored_playlists():
+    playlists_info = mpd.get_stored_playlists_info()
+    sources = collections_sources(sections, aliases, playlists_info, library)
+    for playlist_info in playlists_info:
+        playlist = playlist_info['playlist']
         if playlist not in collections:
-            collections[playlist] = {'mpd_playlist': True,
-                                     'songs':
-                                       mpd.get_stored_playlist_songs(playlist)}
+            collection = previous_collections.get(playlist)
+            if (collection is None or 'mpd_playlist' not in collection or
+                previous_sources['playlists'].get(playlist) !=
+                sources['playlists'][playlist]):
+                collection = {'mpd_playlist': True,
+                              'songs': mpd.get_stored_playlist_songs(playlist)}
+            collections[playlist] = collection
         else:
             warning('MPD playlist [{}] was ignored because a collection with '
                     'the same name already exists'.format(playlist))
-    return collections
+    return collections, sources
+
+
+def split_sections(collections_raw):
+    # (hash, lines) of each section, from a "--alias" line to the next one
+    sections = []
+    for line in collections_raw:
+        if line.startswith('--'):
+            sections.append([])
+        if sections:
+            sections[-1].append(line)
+    return [(hashlib.sha1(''.join(lines).encode()).hexdigest(), lines)
+            for lines in sections]
+
 
+def collections_sources(sections, aliases, playlists_info, library):
+    return {'sections': {section_hash: alias for (section_hash, _), alias
+                         in zip(sections, aliases)},
+            'playlists': {playlist_info['playlist']:
+                          playlist_info.get('last-modified')
+                          for playlist_info in playlists_info},
+            'library': library}
 
-# Dictionary of collections -> human-readable format without MPD playlists
-def optimized_to_raw(collections_optimized):
-    raw = ''
+
+def section_alias(line):
+    return (line[2:] if line[2] not in '@#' else line[3:]).strip()
+
+
+def parse_section(lines, pinned_songs):
+    line = lines[0]
+    alias = section_alias(line)
+    collection = {}
+    if line[2] == '@':
+        collection['sort'] = True
+    elif line[2] == '#':
+        collection['special'] = True
+    for line in lines[1:]:
+        if line.startswith('command:'):
+            collection['command'] = line[8:].strip()
+        elif line.startswith('songs:'):
+            collection['songs'] = []
+        elif line.strip():
+            if ('songs' in collection and
+               (line.startswith('    ') or line.startswith('\t'))):
+                tags = ast.literal_eval('({})'.format(line.strip()))
+                pinned_songs.append((collection['songs'], alias, tags))
+            else:
+                if 'expression' not in collection:
+                    collection['expression'] = line
+                else:
+                    collection['expression'] += line
+    return alias, collection
+
+
+# Dictionary of collections -> human-readable format without MPD playlists,
+# as (alias, text) of each section. The text of the collections in verbatim
+# is reused, every section ends with the same blank lines so that none is
+# glued to the next one
+def optimized_to_raw(collections_optimized, verbatim=None):
+    verbatim = verbatim or {}
     for alias, collection in collections_optimized.items():
         if 'mpd_playlist' in collection:
             continue
-        elif 'sort' in collection:
-            raw += '--@' + alias
+        text = verbatim.get(alias)
+        if text is not None:
+            yield alias, text.rstrip('\n') + '\n\n\n'
+            continue
+        if 'sort' in collection:
+            lines = ['--@' + alias]
         elif 'special' in collection:
-            raw += '--#' + alias
+            lines = ['--#' + alias]
         else:
-            raw += '--' + alias
+            lines = ['--' + alias]
         if 'expression' in collection:
-            raw += '\n' + collection['expression'].rstrip()
+            lines.append(collection['expression'].rstrip())
         if 'command' in collection:
-            raw += '\ncommand: ' + collection['command']
+            lines.append('command: ' + collection['command'])
         if 'songs' in collection and collection['songs']:
-            raw += '\nsongs:'
-            for song in collection['songs']:
-                raw += '\n    ' + repr_tags(mpd.get_tags(song))
-        raw += '\n\n\n'
-    return raw.strip()
+            lines.append('songs:')
+            lines.extend('    ' + repr_tags(mpd.get_tags(song))
+                         for song in collection['songs'])
+        yield alias, '\n'.join(lines) + '\n\n\n'
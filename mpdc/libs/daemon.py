@@ -0,0 +1,229 @@
+# coding: utf-8
+import os
+import io
+import sys
+import json
+import shutil
+import socket
+import contextlib
+import socketserver
+from configparser import ConfigParser
+
+from mpdc.libs.utils import Cache, page
+
+
+# --------------------------------
+# Daemon
+# --------------------------------
+
+# a long-running mpdc process keeps the connection, the caches and the
+# collections in memory, and runs the commands sent by the clients on a unix
+# socket. Messages are JSON objects, one per line:
+#   client -> daemon: {"argv": [...], "cwd": ..., "environ": {...},
+#                      "isatty": ...}, or {"stop": true}
+#   daemon -> client: {"stdout": ...}, {"stderr": ...},
+#                     {"pager": ..., "text": ...}, {"local": true} when the
+#                     command has to run in the client, {"exit": code}
+
+# environment variables of the client applied while running its command
+environ_keys = ('ANSI_COLORS_DISABLED', 'COLUMNS')
+
+
+def socket_path():
+    config = ConfigParser()
+    config.read(os.path.expanduser('~/.mpdc'))
+    profile = 1
+    if 'profiles' in config:
+        profile = int(config['profiles'].get('default', 1))
+    return os.path.join(os.path.dirname(Cache(profile).p), 'daemon.sock')
+
+
+def send(connection, message):
+    connection.sendall(bytes(json.dumps(message) + '\n', 'utf-8'))
+
+
+def connect(path=None):
+    path = path or socket_path()
+    if not os.path.exists(path):
+        return None
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(path)
+    except OSError:
+        connection.close()
+        return None
+    return connection
+
+
+# --------------------------------
+# Client
+# --------------------------------
+
+def forward(argv):
+    # returns the exit code of the command, or None if it has to run here
+    connection = connect()
+    if connection is None:
+        return None
+    environ = {key: os.environ[key] for key in environ_keys
+               if key in os.environ}
+    environ.setdefault('COLUMNS', str(shutil.get_terminal_size().columns))
+    with connection, connection.makefile('r', encoding='utf-8') as replies:
+        send(connection, {'argv': argv, 'cwd': os.getcwd(),
+                          'environ': environ,
+                          'isatty': sys.stdout.isatty()})
+        for line in replies:
+            message = json.loads(line)
+            if 'stdout' in message:
+                sys.stdout.write(message['stdout'])
+                sys.stdout.flush()
+            elif 'stderr' in message:
+                sys.stderr.write(message['stderr'])
+            elif 'pager' in message:
+                page(message['text'], message['pager'])
+            elif 'local' in message:
+                return None
+            elif 'exit' in message:
+                return message['exit']
+    return 1
+
+
+def stop():
+    connection = connect()
+    if connection is None:
+        return False
+    with connection:
+        send(connection, {'stop': True})
+        connection.makefile('r').readline()
+    return True
+
+
+# --------------------------------
+# Server
+# --------------------------------
+
+class ClientOutput(io.TextIOBase):
+
+    def __init__(self, connection, channel, isatty=False):
+        self.connection = connection
+        self.channel = channel
+        self.tty = isatty
+        self.buffer = []
+        self.size = 0
+
+    def isatty(self):
+        return self.tty
+
+    def writable(self):
+        return True
+
+    def write(self, s):
+        self.buffer.append(s)
+        self.size += len(s)
+        if self.size > 65536:
+            self.flush()
+        return len(s)
+
+    def flush(self):
+        if self.buffer:
+            send(self.connection, {self.channel: ''.join(self.buffer)})
+            self.buffer = []
+            self.size = 0
+
+    def page(self, text, pager):
+        self.flush()
+        send(self.connection, {'pager': pager, 'text': text})
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+        request = json.loads(line.decode('utf-8'))
+        if request.get('stop'):
+            send(self.connection, {'exit': 0})
+            self.server.stopping = True
+            return
+        try:
+            code = self.server.run(self.connection, request)
+        except (BrokenPipeError, ConnectionResetError):
+            return
+        send(self.connection, {'exit': code} if code is not None
+                              else {'local': True})
+
+
+class Server(socketserver.UnixStreamServer):
+
+    def __init__(self, path, watcher=None):
+        self.stopping = False
+        self.watcher = watcher
+        super().__init__(path, RequestHandler)
+        os.chmod(path, 0o600)
+
+    def run(self, connection, request):
+        from mpdc import initialize
+        # the idle watcher must not refresh the state during a command
+        with initialize.lock:
+            return self.run_locked(connection, request)
+
+    def run_locked(self, connection, request):
+        from mpdc import initialize
+        from mpdc import mpdc_cli
+        stdout = ClientOutput(connection, 'stdout', request.get('isatty'))
+        stderr = ClientOutput(connection, 'stderr')
+        environ = dict(os.environ)
+        os.environ.update(request.get('environ', {}))
+        cwd = os.getcwd()
+        try:
+            os.chdir(request.get('cwd', cwd))
+            with contextlib.redirect_stdout(stdout), \
+                 contextlib.redirect_stderr(stderr):
+                try:
+                    # with a running watcher, only the collections file is
+                    # checked
+                    initialize.refresh(set() if initialize.mpd.watched
+                                       else None)
+                    if not mpdc_cli.run(request['argv'], forwarded=True):
+                        return None
+                    code = 0
+                except SystemExit as e:
+                    code = e.code if isinstance(e.code, int) else 1
+                except Exception as e:
+                    print('[error] {}: {}'.format(type(e).__name__, e),
+                          file=sys.stderr)
+                    code = 1
+                initialize.collectionsmanager.update()
+            return code
+        finally:
+            stdout.flush()
+            stderr.flush()
+            os.chdir(cwd)
+            os.environ.clear()
+            os.environ.update(environ)
+
+
+def serve(path=None, watch=True):
+    from mpdc import initialize
+    path = path or socket_path()
+    if os.path.exists(path):
+        # a socket left by a daemon which did not stop properly
+        os.unlink(path)
+    server = Server(path, initialize.watch() if watch else None)
+    try:
+        # one request at a time, the state of mpdc is not shared safely
+        while not server.stopping:
+            server.handle_request()
+    finally:
+        server.server_close()
+        if os.path.exists(path):
+            os.unlink(path)
+
+
+def detach():
+    if os.fork():
+        os._exit(0)
+    os.setsid()
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in (0, 1, 2):
+        os.dup2(devnull, fd)
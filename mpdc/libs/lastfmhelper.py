@@ -10,6 +10,7 @@ from datetime import datetime, timedelta
 
 from mpdc.initialize import cache
 from mpdc.libs.utils import similarity, warning
+from mpdc.libs.stats import stats
 
 
 class LastfmHelper:
@@ -46,12 +47,19 @@ class LastfmHelper:
 
     def __init__(self):
         self.timeout = 0
-        self.artists_tags = cache.read('lastfm_artists_tags')
-        self.albums_tags = cache.read('lastfm_albums_tags')
-        self.tracks_tags = cache.read('lastfm_tracks_tags')
+        self.caches = {}
 
-        if not (self.artists_tags and self.albums_tags and self.tracks_tags):
-            warning('You should update the LastFM database')
+    def read_cache(self, name):
+        # the tags are only read by the commands which use them
+        if name not in self.caches:
+            self.caches[name] = cache.read(name)
+            if not self.caches[name]:
+                warning('You should update the LastFM database')
+        return self.caches[name]
+
+    artists_tags = property(lambda self: self.read_cache('lastfm_artists_tags'))
+    albums_tags = property(lambda self: self.read_cache('lastfm_albums_tags'))
+    tracks_tags = property(lambda self: self.read_cache('lastfm_tracks_tags'))
 
     def request(self, method, **args):
         if self.last_request + self.delay > datetime.now():
@@ -62,8 +70,10 @@ class LastfmHelper:
         url = self.url + self.methods[method].format(**args_)
 
         try:
-            raw_json = urllib.request.urlopen(url, timeout=15).read()
+            with stats.timer('lastfm.request'):
+                raw_json = urllib.request.urlopen(url, timeout=15).read()
         except (socket.timeout, urllib.error.URLError):
+            stats.count('lastfm.timeouts')
             if self.timeout == 3:
                 warning('Cannot send the request after 4 attempts')
                 self.timeout = 0
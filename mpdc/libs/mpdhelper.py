@@ -1,37 +1,49 @@
 # coding: utf-8
 import itertools
 import collections
-from subprocess import check_output, Popen, PIPE, STDOUT
 
 import mpd
 
 from mpdc.initialize import cache
-from mpdc.libs.utils import format_mpc_output, OrderedSet
+from mpdc.libs.utils import progress, longest_increasing_subsequence
+from mpdc.libs.stats import stats
+from mpdc.libs.songset import SongIndex
+from mpdc.libs.tagstore import TagStore, TagStoreWriter
+from mpdc.libs.queryengine import QueryEngine
 
 
-# this class uses mpc or python-mpd2 depending on which provides the best
-# performances
+# every request goes through the python-mpd2 connection, bulk work being
+# sent as command lists
 
 class MPDHelper:
 
+    batch_size = 500
+
+    main_tags = ('artist', 'albumartist', 'album', 'title', 'track')
+
+    # evaluate find and search from the cache instead of asking MPD
+    local_queries = True
+
     def __init__(self, host, password, port):
         self.host = host
         self.port = str(port)
         self.password = password
-        self.mpdclient = mpd.MPDClient()
-        if password:
-            self.mpc_c = ['mpc', '-h', password + '@' + host, '-p', self.port]
-        else:
-            self.mpc_c = ['mpc', '-h', host, '-p', self.port]
+        self.mpdclient = CountingMPDClient()
 
         self.all_songs = None
         self.all_songs_tags = None
-        self.all_songs_info = None
+        self.song_index = None
+        self.query_engine = None
         self.first_lately_added_song = None
 
+        # when an idle watcher keeps them fresh, the queue and the current
+        # song are only fetched again after MPD reported a change
+        self.watched = False
+        self.playlist_info = None
+        self.current_song = None
+
     def connect(self):
         try:
-            check_output(self.mpc_c)
             self.mpdclient.connect(self.host, self.port)
             if self.password:
                 self.mpdclient.password(self.password)
@@ -39,28 +51,81 @@ class MPDHelper:
             return False
         return True
 
+    def ping(self):
+        # reconnects if the server closed an idle connection
+        try:
+            self.mpdclient.ping()
+        except (mpd.ConnectionError, OSError):
+            try:
+                self.mpdclient.disconnect()
+            except (mpd.ConnectionError, OSError):
+                pass
+            return self.connect()
+        return True
+
+    def invalidate(self, subsystems):
+        if 'playlist' in subsystems:
+            self.playlist_info = None
+        if 'player' in subsystems:
+            self.current_song = None
+
+    def send_commands(self, commands):
+        # commands are (name, arg1, arg2, ...) tuples, they are sent in
+        # command lists of at most batch_size commands
+        commands = list(commands)
+        self.invalidate(('playlist', 'player'))
+        results = []
+        for start in range(0, len(commands), self.batch_size):
+            self.mpdclient.command_list_ok_begin()
+            for command in commands[start:start + self.batch_size]:
+                getattr(self.mpdclient, command[0])(*command[1:])
+            results.extend(self.mpdclient.command_list_end())
+            if len(commands) > self.batch_size:
+                progress(min(start + self.batch_size, len(commands)),
+                         len(commands))
+        return results
+
+    def command_list(self, command, arguments):
+        return self.send_commands((command,) + tuple(args)
+                                  for args in arguments)
+
 # Playlist functions
 
     def add(self, songs_files):
-        p = Popen(self.mpc_c + ['add'], stdin=PIPE, stdout=PIPE, stderr=STDOUT)
-        p.communicate(input=bytes('\n'.join(songs_files), 'utf-8'))
+        self.command_list('add', ((song,) for song in songs_files))
         self.first_lately_added_song = songs_files[0]
 
     def insert(self, songs_files):
-        p = Popen(self.mpc_c + ['insert'], stdin=PIPE, stdout=PIPE,
-                  stderr=STDOUT)
-        p.communicate(input=bytes('\n'.join(songs_files), 'utf-8'))
+        status = self.mpdclient.status()
+        if 'song' in status:
+            position = int(status['song']) + 1
+            self.command_list('addid', ((song, position + i) for i, song
+                                        in enumerate(songs_files)))
+        else:
+            self.command_list('add', ((song,) for song in songs_files))
         self.first_lately_added_song = songs_files[0]
 
     def remove(self, songs_files):
-        positions = self.get_playlist_positions()
-        songs_ids = [positions[s] for s in songs_files if s in positions]
-        songs_ids = map(str, list(itertools.chain.from_iterable(songs_ids)))
-        p = Popen(self.mpc_c + ['del'], stdin=PIPE, stdout=PIPE, stderr=STDOUT)
-        p.communicate(input=bytes('\n'.join(songs_ids), 'utf-8'))
+        ids = self.get_playlist_ids()
+        songs_ids = [ids[s] for s in songs_files if s in ids]
+        songs_ids = itertools.chain.from_iterable(songs_ids)
+        self.command_list('deleteid', ((song_id,) for song_id in songs_ids))
+
+    def replace(self, songs_files):
+        songs_files = list(songs_files)
+        commands = queue_edits(self.get_playlist_info(),
+                               self.mpdclient.status().get('songid'),
+                               songs_files)
+        if commands:
+            self.send_commands(commands)
+        added_songs = [command[1] for command in commands
+                       if command[0] == 'addid']
+        if added_songs:
+            self.first_lately_added_song = added_songs[0]
 
     def play(self, song_position=1):
         self.mpdclient.play(song_position - 1)
+        self.invalidate(('player',))
 
     def play_file(self, song_file):
         positions = self.get_playlist_positions()
@@ -69,25 +134,44 @@ class MPDHelper:
 
     def clear(self):
         self.mpdclient.clear()
+        self.invalidate(('playlist', 'player'))
 
     def crop(self):
-        check_output(self.mpc_c + ['crop'])
+        current_id = self.mpdclient.status().get('songid')
+        if current_id is not None:
+            songs_ids = [song['id'] for song in self.get_playlist_info()
+                         if song['id'] != current_id]
+            self.command_list('deleteid', ((song_id,) for song_id in songs_ids))
+
+    def get_playlist_info(self):
+        if self.playlist_info is not None:
+            return self.playlist_info
+        playlist_info = self.mpdclient.playlistinfo()
+        if self.watched:
+            self.playlist_info = playlist_info
+        return playlist_info
 
     def get_playlist_songs(self):
-        output = check_output(self.mpc_c + ['-f', '%file%', 'playlist'])
-        return format_mpc_output(output.decode())
+        return [song['file'] for song in self.get_playlist_info()]
 
     def get_playlist_positions(self):
         positions = collections.defaultdict(list)
-        output = check_output(self.mpc_c + ['-f', '%file% %position%',
-                                            'playlist'])
-        for line in format_mpc_output(output.decode()):
-            song, position = line.rsplit(' ', 1)
-            positions[song].append(int(position))
+        for song in self.get_playlist_info():
+            positions[song['file']].append(int(song['pos']) + 1)
         return positions
 
+    def get_playlist_ids(self):
+        ids = collections.defaultdict(list)
+        for song in self.get_playlist_info():
+            ids[song['file']].append(song['id'])
+        return ids
+
     def get_current_song(self):
-        song = self.mpdclient.currentsong()
+        song = self.current_song
+        if song is None:
+            song = self.mpdclient.currentsong()
+            if self.watched:
+                self.current_song = song
         return song.get('file', None)
 
 # Database functions
@@ -96,31 +180,86 @@ class MPDHelper:
         return list(self.get_all_songs_tags())
 
     def get_all_songs_tags(self, update=False):
-        if self.all_songs_tags is not None and not update:
-            pass
-        elif cache.exists('songs_tags') and not update:
-            self.all_songs_tags = cache.read('songs_tags')
-        else:
-            self.all_songs_tags = collections.OrderedDict()
-            for song in self.mpdclient.listallinfo():
-                if 'file' in song:
-                    self.all_songs_tags[song['file']] = {
-                        'artist': self.clear_tag(song.get('artist', '')),
-                        'albumartist': self.clear_tag(song.get('albumartist',
-                                                      song.get('artist', ''))),
-                        'album': self.clear_tag(song.get('album', '')),
-                        'title': self.clear_tag(song.get('title', '')),
-                        'track': self.clear_tag(song.get('track', ''))
-                    }
-            cache.write('songs_tags', self.all_songs_tags)
+        # a TagStore: columns are read from the cache file when first used
+        if self.all_songs_tags is None or update:
+            store = None if update else cache.read_store('songs_info')
+            if store is None:
+                db_update = self.stats()['db_update']
+                writer = TagStoreWriter()
+                for song_file, song in self.iterate('listallinfo'):
+                    writer.add(song_file, song)
+                self.set_all_songs_tags(writer, db_update)
+            else:
+                self.all_songs_tags = store
         return self.all_songs_tags
 
+    def set_all_songs_tags(self, writer, db_update):
+        self.song_index = None
+        self.query_engine = None
+        # written section by section then memory-mapped, the store is never
+        # held whole in memory
+        cache.write_bytes('songs_info', writer.chunks())
+        cache.write('songs_info_db_update', db_update)
+        self.all_songs_tags = cache.read_store('songs_info')
+        if self.all_songs_tags is None:
+            # the cache cannot be written
+            self.all_songs_tags = TagStore(writer.to_bytes())
+
+    def iterate(self, command, *args):
+        # (file, tags) of the songs, read one by one from the connection,
+        # every tag MPD knows, multi-valued tags being lists
+        self.mpdclient.iterate = True
+        try:
+            for song in getattr(self.mpdclient, command)(*args):
+                if 'file' in song:
+                    yield song.pop('file'), song
+        finally:
+            self.mpdclient.iterate = False
+
+    def sync_all_songs_tags(self):
+        # patches the cache with the songs modified since the last update,
+        # returns False when a full update is needed
+        if not cache.exists('songs_info_db_update'):
+            return False
+        since = cache.read('songs_info_db_update', default=None)
+        old_songs_tags = cache.read_store('songs_info')
+        if since is None or old_songs_tags is None:
+            return False
+        db_update = self.stats()['db_update']
+        try:
+            modified = self.mpdclient.find('modified-since', since)
+        except mpd.CommandError:
+            return False
+        modified = {song.pop('file'): song for song in modified
+                    if 'file' in song}
+        # the list of files gives the new library order and the deleted songs
+        files = [song_file for song_file, song in self.iterate('listall')]
+        # added files may be older than the last update (moved, copied...)
+        missing = [f for f in files if f not in old_songs_tags and
+                   f not in modified]
+        for songs in self.command_list('lsinfo', ((f,) for f in missing)):
+            for song in songs:
+                if 'file' in song:
+                    modified[song.pop('file')] = song
+        writer = TagStoreWriter()
+        for song_file in files:
+            if song_file in modified:
+                writer.add(song_file, modified[song_file])
+            elif song_file in old_songs_tags:
+                writer.add(song_file, old_songs_tags[song_file])
+        self.set_all_songs_tags(writer, db_update)
+        return True
+
+    def get_tag_values(self, filename, tag):
+        songs_tags = self.get_all_songs_tags()
+        values = songs_tags.tag_values(filename, tag)
+        if not values and tag == 'albumartist':
+            values = songs_tags.tag_values(filename, 'artist')
+        return values
+
     def get_tag(self, filename, tag, empty=''):
-        if tag in ('artist', 'albumartist', 'album', 'title', 'track'):
-            return self.get_all_songs_tags()[filename][tag] or empty
-        else:
-            tag = self.mpdclient.listallinfo(filename)[0].get(tag, empty)
-            return self.clear_tag(tag)
+        values = self.get_tag_values(filename, tag)
+        return values[0] or empty if values else empty
 
     def get_tags(self, filename, tags_list=None, empty=''):
         if tags_list is None:
@@ -128,32 +267,58 @@ class MPDHelper:
         return tuple([self.get_tag(filename, tag, empty) for tag in tags_list])
 
     def list_artists(self):
-        output = check_output(self.mpc_c + ['list', 'artist'])
-        return format_mpc_output(output.decode())
+        artists = []
+        for artist in self.mpdclient.list('artist'):
+            # python-mpd2 >= 1.0 returns a dictionary for each value
+            if isinstance(artist, dict):
+                artist = artist.get('artist', '')
+            if artist:
+                artists.append(artist)
+        return artists
 
     def list_albums(self):
         albums = []
-        for song in self.get_all_songs_tags().values():
-            if song['album'] and song['albumartist']:
-                albums.append((song['album'], song['albumartist']))
+        for song in self.get_all_songs_tags():
+            album, albumartist = self.get_tags(song, ('album', 'albumartist'))
+            if album and albumartist:
+                albums.append((album, albumartist))
         return albums
 
     def list_tracks(self):
         tracks = []
-        for song in self.get_all_songs_tags().values():
-            if song['title'] and song['albumartist']:
-                tracks.append((song['title'], song['albumartist']))
+        for song in self.get_all_songs_tags():
+            title, albumartist = self.get_tags(song, ('title', 'albumartist'))
+            if title and albumartist:
+                tracks.append((title, albumartist))
         return tracks
 
+    def get_song_index(self):
+        if self.song_index is None:
+            self.song_index = SongIndex(self.get_all_songs_tags())
+        return self.song_index
+
+    def songset(self, songs_files=()):
+        return self.get_song_index().songset(songs_files)
+
+    def get_query_engine(self):
+        if self.query_engine is None:
+            self.query_engine = QueryEngine(self.get_all_songs_tags())
+        return self.query_engine
+
     def search(self, filtername, pattern):
         if filtername == 'extension':
             return [s for s in self.get_all_songs() if
                     s.lower().endswith(pattern.lower())]
+        elif self.local_queries:
+            return self.get_query_engine().search(filtername, pattern)
         else:
-            output = check_output(self.mpc_c + ['search', filtername, pattern])
-            return format_mpc_output(output.decode())
+            return [song['file'] for song in
+                    self.mpdclient.search(filtername, pattern)
+                    if 'file' in song]
 
     def search_multiple(self, **filters):
+        if self.local_queries:
+            return self.get_query_engine().search_multiple(**filters)
         query = []
         for filtername, pattern in filters.items():
             query.extend([filtername, pattern])
@@ -162,16 +327,43 @@ class MPDHelper:
     def find(self, filtername, pattern):
         if filtername == 'extension':
             return [s for s in self.get_all_songs() if s.endswith(pattern)]
+        elif self.local_queries:
+            return self.get_query_engine().find(filtername, pattern)
         else:
             return [song['file'] for song in
                     self.mpdclient.find(filtername, pattern)]
 
     def find_multiple(self, **filters):
+        if self.local_queries:
+            return self.get_query_engine().find_multiple(**filters)
         query = []
         for filtername, pattern in filters.items():
             query.extend([filtername, pattern])
         return [song['file'] for song in self.mpdclient.find(*query)]
 
+    def find_songs(self, tags_list):
+        # file of the first song having each (artist, album, title, track),
+        # None when no song has them. The songs cache answers, MPD is asked
+        # about the remaining songs in command lists
+        tags_list = list(tags_list)
+        files = [None] * len(tags_list)
+        if self.local_queries:
+            files = self.get_query_engine().find_first(
+                ('album', 'title', 'artist', 'track'),
+                [(album, title, artist, track) for artist, album, title, track
+                 in tags_list])
+        missing = [i for i, song_file in enumerate(files) if song_file is None]
+        if missing:
+            results = self.command_list('find', (
+                ('artist', artist, 'album', album, 'title', title,
+                 'track', track) for artist, album, title, track
+                in (tags_list[i] for i in missing)))
+            for i, songs in zip(missing, results):
+                songs = [song['file'] for song in songs if 'file' in song]
+                if songs:
+                    files[i] = songs[0]
+        return files
+
     def stats(self):
         return self.mpdclient.stats()
 
@@ -187,8 +379,14 @@ class MPDHelper:
         return [song['file'] for song in self.mpdclient.listplaylistinfo(name)]
 
     def add_songs_stored_playlist(self, name, songs_files):
-        for song_file in songs_files:
-            self.mpdclient.playlistadd(name, song_file)
+        self.command_list('playlistadd', ((name, song_file) for song_file
+                                          in songs_files))
+
+    def remove_songs_stored_playlist(self, name, positions):
+        # from the end, so that the remaining positions stay valid
+        positions = sorted(set(positions), reverse=True)
+        self.command_list('playlistdelete', ((name, position) for position
+                                             in positions))
 
     def clear_stored_playlist(self, name):
         self.mpdclient.playlistclear(name)
@@ -201,8 +399,187 @@ class MPDHelper:
         return tag
 
     def set_sort(self, songs_files):
-        all_songs = self.get_all_songs()
-        return OrderedSet([song for song in all_songs if song in songs_files])
-
-    def update_cache(self):
-        self.get_all_songs_tags(update=True)
+        return self.songset(songs_files).sorted()
+
+    def update_cache(self, full=False):
+        with cache.lock():
+            if full or not self.sync_all_songs_tags():
+                self.get_all_songs_tags(update=True)
+
+
+def queue_edits(queue, current_id, songs_files):
+    # commands turning the queue (playlistinfo) into songs_files with few
+    # edits: the entries which are not in songs_files are deleted, the
+    # longest run of the others already in order stays, the other songs are
+    # moved or added after the song preceding them. The current song, if it
+    # stays, is kept and keeps playing
+    # (id, position) of the entry of the queue matched by each song
+    matched = subsequence_entries(queue, current_id, songs_files)
+    if matched is None:
+        entries = collections.defaultdict(collections.deque)
+        for position, song in enumerate(queue):
+            if song['id'] == current_id:
+                entries[song['file']].appendleft((song['id'], position))
+            else:
+                entries[song['file']].append((song['id'], position))
+        matched = [entries[song_file].popleft() if entries.get(song_file)
+                   else None for song_file in songs_files]
+    kept_ids = {entry[0] for entry in matched if entry is not None}
+    commands = [('deleteid', song['id']) for song in queue
+                if song['id'] not in kept_ids]
+
+    kept = [i for i, entry in enumerate(matched) if entry is not None]
+    stable = {kept[i] for i in longest_increasing_subsequence(
+              [matched[i][1] for i in kept])}
+    # entries of the queue are ordered by keys: (position, -1) for the
+    # entries not moved yet, (position of the last stable entry before it,
+    # index in songs_files) for a moved or added song, which lands right
+    # after the song preceding it. The position of a song in the queue is
+    # the number of keys before its own, counted in a Fenwick tree
+    keys = []
+    head = -1
+    for i, entry in enumerate(matched):
+        if i in stable:
+            head = entry[1]
+            keys.append((head, -1))
+        else:
+            keys.append((head, i))
+    ranks = sorted(set(keys).union((entry[1], -1) for entry in matched
+                                   if entry is not None))
+    ranks = {key: rank for rank, key in enumerate(ranks)}
+    tree = [0] * (len(ranks) + 1)
+
+    def add(key, value):
+        rank = ranks[key] + 1
+        while rank < len(tree):
+            tree[rank] += value
+            rank += rank & -rank
+
+    def count_before(key):
+        rank, count = ranks[key], 0
+        while rank > 0:
+            count += tree[rank]
+            rank -= rank & -rank
+        return count
+
+    for entry in matched:
+        if entry is not None:
+            add((entry[1], -1), 1)
+    for i, (song_file, entry) in enumerate(zip(songs_files, matched)):
+        if i in stable:
+            continue
+        if entry is not None:
+            add((entry[1], -1), -1)
+        position = count_before(keys[i])
+        add(keys[i], 1)
+        if entry is None:
+            commands.append(('addid', song_file, position))
+        else:
+            commands.append(('moveid', entry[0], position))
+    return commands
+
+
+
+def subsequence_entries(queue, current_id, songs_files):
+    # when songs_files is a subsequence of the queue (the queue is cropped),
+    # (id, position) of entries of the queue in order, so that only
+    # deletions are needed even with duplicates. None when songs_files is
+    # not a subsequence, or when the current song stays but its entry cannot
+    # be one of them
+    firsts = []
+    position = 0
+    for song_file in songs_files:
+        while position < len(queue) and queue[position]['file'] != song_file:
+            position += 1
+        if position == len(queue):
+            return None
+        firsts.append(position)
+        position += 1
+    # the latest entries matching each suffix of songs_files
+    lasts = [0] * len(songs_files)
+    position = len(queue) - 1
+    for i in reversed(range(len(songs_files))):
+        while queue[position]['file'] != songs_files[i]:
+            position -= 1
+        lasts[i] = position
+        position -= 1
+    positions = firsts
+    current = next((position for position, song in enumerate(queue)
+                    if song['id'] == current_id), None)
+    if current is not None:
+        for i, song_file in enumerate(songs_files):
+            if (song_file == queue[current]['file'] and
+                (i == 0 or firsts[i - 1] < current) and
+                (i + 1 == len(songs_files) or lasts[i + 1] > current)):
+                positions = firsts[:i] + [current] + lasts[i + 1:]
+                break
+        else:
+            if queue[current]['file'] in songs_files:
+                return None
+    return [(queue[position]['id'], position) for position in positions]
+
+
+# the commands are created again, so that they call the _execute below
+@mpd.base.mpd_command_provider
+class CountingMPDClient(mpd.MPDClient):
+    # counts the requests sent to MPD (a command list is one request) and
+    # the bytes exchanged, for the profiling of the collections, and times
+    # the commands when the instrumentation is enabled
+
+    def __init__(self):
+        super().__init__()
+        self.round_trips = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def connect(self, *args, **kwargs):
+        super().connect(*args, **kwargs)
+        self._rbfile = CountingReader(self._rbfile, self)
+
+    def _execute(self, command, args, retval):
+        if not stats.enabled:
+            return super()._execute(command, args, retval)
+        stats.count('mpd.commands')
+        if self._command_list is not None:
+            return super()._execute(command, args, retval)
+        with stats.timer('mpd.' + command):
+            return super()._execute(command, args, retval)
+
+    def command_list_end(self):
+        with stats.timer('mpd.command_list'):
+            return super().command_list_end()
+
+    def _write_line(self, line):
+        if self._command_list is None:
+            self.round_trips += 1
+            if stats.enabled:
+                stats.count('mpd.round_trips')
+        sent = len(line.encode('utf-8')) + 1
+        self.bytes_sent += sent
+        if stats.enabled:
+            stats.count('mpd.bytes_sent', sent)
+        super()._write_line(line)
+
+
+class CountingReader:
+
+    def __init__(self, rfile, client):
+        self.rfile = rfile
+        self.client = client
+
+    def readline(self, *args):
+        data = self.rfile.readline(*args)
+        self.client.bytes_received += len(data)
+        if stats.enabled:
+            stats.count('mpd.bytes_received', len(data))
+        return data
+
+    def read(self, *args):
+        data = self.rfile.read(*args)
+        self.client.bytes_received += len(data)
+        if stats.enabled:
+            stats.count('mpd.bytes_received', len(data))
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self.rfile, name)
@@ -1,74 +1,429 @@
 # coding: utf-8
+import os
 import re
 import sys
+import time
 import random
+import hashlib
+import operator
 import subprocess
 import collections
 
-from ply import lex
-from ply import yacc
-
-from mpdc.initialize import mpd, collectionsmanager, lastfm, enable_command
-from mpdc.libs.utils import format_mpc_output, warning, OrderedSet
+from mpdc.initialize import mpd, collectionsmanager, lastfm, cache, \
+                            enable_command
+from mpdc.libs.utils import format_mpc_output, warning, esc_quotes, \
+                           OrderedSet
+from mpdc.libs.stats import stats
 
 
 # --------------------------------
 # Lexer
 # --------------------------------
 
-tokens = (
-    'FILTER', 'MODIFIER', 'COLLECTION',
-    'UNION', 'INTERSECTION', 'COMPLEMENT', 'SYMMETRIC_DIFFERENCE',
-    'LPAREN', 'RPAREN',
-)
-
+# a filter is one or two letters followed by a quoted pattern, a collection
+# is a word or a quoted name. Filters are tried before collections.
+
+token_regex = re.compile(r'''
+    (?P<FILTER>[abtngdcpfexlr]{1,2}(?:"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*'))
+  | (?P<COLLECTION>\w+|"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')
+  | (?P<MODIFIER>\|[ ]*\w+)
+  | (?P<UNION>\+)
+  | (?P<INTERSECTION>\.)
+  | (?P<COMPLEMENT>-)
+  | (?P<SYMMETRIC_DIFFERENCE>%)
+  | (?P<LPAREN>\()
+  | (?P<RPAREN>\))
+  | (?P<ignore>[ \t\n]+)
+''', re.VERBOSE | re.UNICODE | re.IGNORECASE)
+
+Token = collections.namedtuple('Token', ('type', 'value'))
+
+
+def tokenize(expression):
+    position = 0
+    while position < len(expression):
+        match = token_regex.match(expression, position)
+        if match is None:
+            warning('Illegal character `{}`'.format(expression[position]))
+            sys.exit(0)
+        position = match.end()
+        kind, value = match.lastgroup, match.group()
+        if kind == 'ignore':
+            continue
+        if kind == 'FILTER':
+            value = value.replace('\\' + value[-1], value[-1])
+        elif kind == 'COLLECTION' and value[0] in '"\'':
+            value = value[1:-1].replace('\\' + value[0], value[0])
+        yield Token(kind, value)
 
-t_UNION = r'\+'
-t_INTERSECTION = r'\.'
-t_COMPLEMENT = r'\-'
-t_SYMMETRIC_DIFFERENCE = r'%'
-t_LPAREN = r'\('
-t_RPAREN = r'\)'
-t_MODIFIER = r'\|[ ]*\w+'
 
+# --------------------------------
+# Parser
+# --------------------------------
 
-def t_FILTER(t):
-    r'([abtngdcpfexlr]{1,2}"(?:[^"\\]|\\.)*") |' \
-    r'([abtngdcpfexlr]{1,2}\'(?:[^\'\\]|\\.)*\')'
-    delimiter = next(c for c in t.value if c in '"\'')
-    t.value = t.value.replace('\\' + delimiter, delimiter)
-    return t
+# expression: operand (operator operand | MODIFIER)*
+# operand:    COLLECTION | FILTER | LPAREN expression RPAREN
+#
+# operators and modifiers are applied from left to right: "a + b |r5 . c"
+# is "((a + b) |r5) . c"
+#
+# expressions are compiled to syntax trees made of tuples, so that identical
+# subtrees are equal:
+#   ('collection', name)
+#   ('filter', tag, exact, pattern)
+#   ('operation', operator, left, right)
+#   ('modifier', modifier, operand)
+#   ('empty',)
+#   ('filters', exact, ((tag, pattern), ...)), made by the planner
+
+EMPTY = ('empty',)
+
+modifiers_regex = re.compile(r'^(s|r[0-9]+|ra[0-9]+|rb[0-9]+|d[0-9]+|'
+                             r'i?sa[0-9]+|i?sb[0-9]+)$')
+random_modifier = re.compile(r'^(r|ra|rb|d)[0-9]+$')
+lastfm_modifier = re.compile(r'^i?s[ab][0-9]+$')
+
+
+class Parser:
+
+    # the least recently used syntax trees are dropped beyond this number, so
+    # that a daemon does not keep every expression it was given
+    max_syntax_trees = 4096
+
+    def __init__(self):
+        # expression -> syntax tree
+        self.syntax_trees = collections.OrderedDict()
+        # while an expression is profiled, the collections it uses are run
+        # by the same profiling executor
+        self.profiler = None
+
+    def parse(self, expression):
+        # returns the set of songs of a collections expression
+        node = plan(self.syntax_tree(expression))
+        if self.profiler is not None:
+            return self.profiler.run(node)
+        return Executor().run(node)
+
+    def profile(self, expression):
+        # returns the set of songs and the profile of its evaluation
+        self.profiler = ProfilingExecutor()
+        try:
+            songs = self.profiler.run(plan(self.syntax_tree(expression)))
+        finally:
+            profile, self.profiler = self.profiler.profile, None
+        return songs, profile['children'][0]
+
+    def syntax_tree(self, expression):
+        if expression in self.syntax_trees:
+            self.syntax_trees.move_to_end(expression)
+            return self.syntax_trees[expression]
+        tokens = list(tokenize(expression))
+        node, position = self.expression(tokens, 0)
+        if position != len(tokens):
+            syntax_error()
+        self.syntax_trees[expression] = node
+        if len(self.syntax_trees) > self.max_syntax_trees:
+            self.syntax_trees.popitem(last=False)
+        return node
+
+    def expression(self, tokens, position):
+        node, position = self.operand(tokens, position)
+        while position < len(tokens):
+            token = tokens[position]
+            if token.type == 'MODIFIER':
+                modifier = token.value[1:].lstrip()
+                if not modifiers_regex.match(modifier):
+                    warning('Modifier [{}] does not exist'.format(modifier))
+                    sys.exit(0)
+                node = ('modifier', modifier, node)
+                position += 1
+            elif token.type in operators:
+                other, position = self.operand(tokens, position + 1)
+                node = ('operation', token.type, node, other)
+            else:
+                break
+        return node, position
+
+    def operand(self, tokens, position):
+        if position == len(tokens):
+            syntax_error()
+        token = tokens[position]
+        if token.type == 'COLLECTION':
+            return ('collection', token.value), position + 1
+        elif token.type == 'FILTER':
+            return compile_filter(token.value), position + 1
+        elif token.type == 'LPAREN':
+            node, position = self.expression(tokens, position + 1)
+            if position == len(tokens) or tokens[position].type != 'RPAREN':
+                syntax_error()
+            return node, position + 1
+        syntax_error()
+
+
+def descendants(node):
+    # the node and all the nodes below it
+    yield node
+    if node[0] == 'operation':
+        yield from descendants(node[2])
+        yield from descendants(node[3])
+    elif node[0] == 'modifier':
+        yield from descendants(node[2])
+
+
+def compile_filter(value):
+    exact = True if value[0].isupper() else False
+    alias = (value[0] if value[1] in '"\'' else value[0:2]).lower()
+    name = filters_alias.get(alias, '')
+    pattern = value[2:-1] if value[1] in '"\'' else value[3:-1]
+    if not name:
+        warning('Filter [{}] does not exist'.format(alias))
+        sys.exit(0)
+    return ('filter', name, exact, pattern)
 
 
-def t_COLLECTION(t):
-    r'\w+ |' \
-    r'"((?:[^"\\]|\\.)*") |' \
-    r'\'((?:[^\'\\]|\\.)*\')'
-    if t.value[0] == '"':
-        t.value = t.value.replace('\"', '"')[1:-1]
-    elif t.value[0] == "'":
-        t.value = t.value.replace("\'", "'")[1:-1]
-    return t
+def syntax_error():
+    warning('Syntax error')
+    sys.exit(0)
 
 
-def t_error(t):
-    warning('Illegal character `{}`'.format(t.value[0]))
-    sys.exit(0)
+parser = Parser()
 
 
-t_ignore = ' \t\n'
+# --------------------------------
+# Planner
+# --------------------------------
 
-lexer = lex.lex(debug=0, reflags=re.UNICODE|re.IGNORECASE)
+# simplifies a syntax tree before it is run: empty operands are propagated,
+# identical deterministic operands are folded, the songs of the library
+# minus "all" is empty, and intersections of filters are merged into one
+# find (or search) with several filters, a single query to MPD
+
+def plan(node):
+    kind = node[0]
+    if kind == 'operation':
+        name, left, right = node[1], plan(node[2]), plan(node[3])
+        if left == EMPTY:
+            return right if name in ('UNION', 'SYMMETRIC_DIFFERENCE') \
+                else EMPTY
+        if right == EMPTY:
+            return EMPTY if name == 'INTERSECTION' else left
+        if left == right and is_deterministic(left):
+            return left if name in ('UNION', 'INTERSECTION') else EMPTY
+        if (name == 'COMPLEMENT' and right == ('collection', 'all') and
+            in_library(left)):
+            return EMPTY
+        if name == 'INTERSECTION':
+            return push_filters(('operation', name, left, right))
+        return ('operation', name, left, right)
+    elif kind == 'modifier':
+        operand = plan(node[2])
+        # every modifier gives nothing from nothing
+        return EMPTY if operand == EMPTY else ('modifier', node[1], operand)
+    return node
+
+
+def intersected(node):
+    # operands of a chain of intersections, from left to right
+    if node[0] == 'operation' and node[1] == 'INTERSECTION':
+        return intersected(node[2]) + intersected(node[3])
+    return [node]
+
+
+def push_filters(node):
+    operands = intersected(node)
+    filters = {True: collections.OrderedDict(),
+               False: collections.OrderedDict()}
+    others = []
+    for operand in operands:
+        if operand[0] == 'filter':
+            tag, exact, pattern = operand[1:]
+            if (not tag.startswith('lastfm') and tag != 'extension' and
+                tag not in filters[exact]):
+                filters[exact][tag] = pattern
+                continue
+        elif operand[0] == 'filters' and not any(
+                tag in filters[operand[1]] for tag, pattern in operand[2]):
+            # already merged in a nested intersection
+            filters[operand[1]].update(operand[2])
+            continue
+        others.append(operand)
+    if max(len(f) for f in filters.values()) < 2:
+        return node
+    merged = []
+    for exact in (True, False):
+        if len(filters[exact]) > 1:
+            merged.append(('filters', exact, tuple(filters[exact].items())))
+        elif filters[exact]:
+            (tag, pattern), = filters[exact].items()
+            merged.append(('filter', tag, exact, pattern))
+    # the songs of an intersection follow the order of its last operand,
+    # filters give songs in the library order
+    if operands[-1] in others:
+        operands = merged + others
+    else:
+        operands = others + merged
+    node = operands[0]
+    for operand in operands[1:]:
+        node = ('operation', 'INTERSECTION', node, operand)
+    return node
+
+
+def is_deterministic(node):
+    # gives the same songs each time it is run
+    kind = node[0]
+    if kind == 'collection':
+        return (node[1] not in collectionsmanager.c or
+                not evaluator.is_random(node[1]))
+    elif kind == 'operation':
+        return is_deterministic(node[2]) and is_deterministic(node[3])
+    elif kind == 'modifier':
+        return (not random_modifier.match(node[1]) and
+                is_deterministic(node[2]))
+    return True
+
+
+def in_library(node):
+    # gives only songs of the library (not streams or other files)
+    kind = node[0]
+    if kind == 'collection':
+        return node[1] in ('all', 'A', 'B') and \
+            node[1] not in collectionsmanager.c
+    elif kind == 'operation':
+        name, left, right = node[1:]
+        if name == 'INTERSECTION':
+            return in_library(left) or in_library(right)
+        elif name == 'COMPLEMENT':
+            return in_library(left)
+        return in_library(left) and in_library(right)
+    elif kind == 'modifier':
+        return (node[1] == 's' or lastfm_modifier.match(node[1]) or
+                in_library(node[2]))
+    return True
+
+
+def cost(node):
+    # rough cost of running a node, the cheapest operand of an
+    # intersection is run first
+    kind = node[0]
+    if kind == 'collection':
+        if node[1] in collectionsmanager.c:
+            if node[1] in evaluator.results or evaluator.key(node[1]):
+                return 1
+            return 10
+        return 1 if node[1] == 'all' else 5
+    elif kind == 'filter':
+        if node[1].startswith('lastfm'):
+            return 20
+        return 1 if node[2] else 2
+    elif kind == 'filters':
+        return 1 if node[1] else 2
+    elif kind == 'operation':
+        return cost(node[2]) + cost(node[3])
+    elif kind == 'modifier':
+        return cost(node[2]) + (20 if lastfm_modifier.match(node[1]) else 1)
+    return 0
 
 
 # --------------------------------
-# Parser
+# Executor
 # --------------------------------
 
-precedence = (
-    ('left', 'MODIFIER'),
-    ('left', 'UNION', 'INTERSECTION', 'COMPLEMENT', 'SYMMETRIC_DIFFERENCE'),
-)
+class Executor:
+
+    def __init__(self):
+        # results of the deterministic subtrees already run
+        self.results = {}
+
+    def run(self, node):
+        if node in self.results:
+            return self.results[node]
+        kind = node[0]
+        if kind == 'empty':
+            songs = mpd.songset()
+        elif kind == 'collection':
+            songs = collection(node[1])
+        elif kind == 'filter':
+            songs = filter_songs(*node[1:])
+        elif kind == 'filters':
+            filters = dict(node[2])
+            songs = mpd.songset(mpd.find_multiple(**filters) if node[1]
+                                else mpd.search_multiple(**filters))
+        elif kind == 'operation':
+            songs = self.run_operation(*node[1:])
+        elif kind == 'modifier':
+            songs = modify(self.run(node[2]), node[1])
+        if is_deterministic(node):
+            self.results[node] = songs
+        return songs
+
+    def run_operation(self, name, left, right):
+        if name == 'INTERSECTION' and cost(right) < cost(left):
+            songs = self.run(right)
+            # the order of the result is the order of the right operand
+            return self.run(left) & songs if songs else songs
+        songs = self.run(left)
+        if not songs and name in ('INTERSECTION', 'COMPLEMENT'):
+            return songs
+        return operators[name](songs, self.run(right))
+
+
+class ProfilingExecutor(Executor):
+    # records, for each node run: its wall time, the number of songs of its
+    # result, the requests sent to MPD and the bytes exchanged, the figures
+    # of a node including those of its children
+
+    def __init__(self):
+        super().__init__()
+        self.profile = {'children': []}
+        self.stack = [self.profile]
+
+    def run(self, node):
+        client = mpd.mpdclient
+        entry = collections.OrderedDict([
+            ('node', describe(node)), ('cached', node in self.results),
+            ('time', 0), ('songs', 0), ('round_trips', 0), ('bytes', 0),
+            ('children', [])])
+        self.stack[-1]['children'].append(entry)
+        self.stack.append(entry)
+        round_trips = client.round_trips
+        transferred = client.bytes_sent + client.bytes_received
+        start = time.perf_counter()
+        try:
+            songs = super().run(node)
+        finally:
+            self.stack.pop()
+        entry['time'] = time.perf_counter() - start
+        entry['songs'] = len(songs)
+        entry['round_trips'] = client.round_trips - round_trips
+        entry['bytes'] = (client.bytes_sent + client.bytes_received -
+                          transferred)
+        return songs
+
+
+def describe(node):
+    # short text of a node, in the syntax of the expressions
+    kind = node[0]
+    if kind == 'collection':
+        return node[1] if re.match(r'^\w+$', node[1]) else \
+            '"' + esc_quotes(node[1]) + '"'
+    elif kind == 'filter':
+        alias = filters_names[node[1]]
+        return (alias.upper() if node[2] else alias) + \
+            '"' + esc_quotes(node[3]) + '"'
+    elif kind == 'filters':
+        return '{}({})'.format('find' if node[1] else 'search', ', '.join(
+            '{}="{}"'.format(tag, esc_quotes(pattern))
+            for tag, pattern in node[2]))
+    elif kind == 'operation':
+        return operators_symbols[node[1]]
+    elif kind == 'modifier':
+        return '|' + node[1]
+    return '(empty)'
+
+
+# --------------------------------
+# Evaluation
+# --------------------------------
 
 filters_alias = {
     'a': 'artist',
@@ -88,83 +443,81 @@ filters_alias = {
     'lt': 'lastfm_t'
 }
 
+filters_names = {name: alias for alias, name in filters_alias.items()}
+
 
 def exclude_songs(songs):
     if 'special' in collectionsmanager.c.get('exclude', {}):
-        ex_songs = parser.parse('exclude',
-                   lexer=lex.lex(debug=0, reflags=re.UNICODE|re.IGNORECASE))
-        return songs - ex_songs
+        return songs - evaluator.evaluate('exclude')
     return songs
 
 
-def p_expression_collection(p):
-    'expression : COLLECTION'
-    p[0] = OrderedSet()
-    if p[1] in collectionsmanager.c:
-        collection = collectionsmanager.c[p[1]]
-        if 'expression' in collection:
-            p[0] |= parser.parse(collection['expression'],
-                    lexer=lex.lex(debug=0, reflags=re.UNICODE|re.IGNORECASE))
-        if 'songs' in collection:
-            p[0] |= OrderedSet(collection['songs'])
-        if enable_command and 'command' in collection:
-            try:
+def collection_songs(alias):
+    songs = mpd.songset()
+    collection = collectionsmanager.c[alias]
+    if 'expression' in collection:
+        songs |= parser.parse(collection['expression'])
+    if 'songs' in collection:
+        songs |= collection['songs']
+    if enable_command and 'command' in collection:
+        try:
+            with stats.timer('subprocess.command'):
                 output = subprocess.check_output(collection['command'],
                                                  shell=True)
-                p[0] |= OrderedSet(format_mpc_output(output.decode()))
-            except subprocess.CalledProcessError:
-                warning('Error while executing `command` in collection [{}]'.
-                        format(p[1]))
-                sys.exit(0)
-        if 'sort' in collection:
-            p[0] = mpd.set_sort(p[0])
-    elif p[1] == 'all':
-        p[0] = OrderedSet(mpd.get_all_songs())
-    elif p[1] == 'c':
-        p[0] = OrderedSet(mpd.get_playlist_songs())
-    elif p[1] == 'C':
+            songs |= format_mpc_output(output.decode())
+        except subprocess.CalledProcessError:
+            warning('Error while executing `command` in collection [{}]'.
+                    format(alias))
+            sys.exit(0)
+    if 'sort' in collection:
+        songs = mpd.set_sort(songs)
+    return songs
+
+
+def collection(name):
+    songs = mpd.songset()
+    if name in collectionsmanager.c:
+        songs = evaluator.evaluate(name)
+    elif name == 'all':
+        songs = mpd.get_song_index().all()
+    elif name == 'c':
+        songs = mpd.songset(mpd.get_playlist_songs())
+    elif name == 'C':
         c_song = mpd.get_current_song()
         if c_song is not None:
-            p[0] = OrderedSet([c_song])
-    elif p[1] == 'A':
+            songs = mpd.songset([c_song])
+    elif name == 'A':
         c_song = mpd.get_current_song()
         if c_song is not None:
-            p[0] = OrderedSet(mpd.find('artist',
-                                       mpd.get_tag(c_song, 'artist')))
-    elif p[1] == 'B':
+            songs = mpd.songset(mpd.find('artist',
+                                         mpd.get_tag(c_song, 'artist')))
+    elif name == 'B':
         c_song = mpd.get_current_song()
         if c_song is not None:
-            p[0] = OrderedSet(mpd.find_multiple(
-                              albumartist=mpd.get_tag(c_song, 'albumartist'),
-                              album=mpd.get_tag(c_song, 'album')))
-            if not p[0]:
-                p[0] = OrderedSet(mpd.find_multiple(
-                                  artist=mpd.get_tag(c_song, 'artist'),
-                                  album=mpd.get_tag(c_song, 'album')))
+            songs = mpd.songset(mpd.find_multiple(
+                                albumartist=mpd.get_tag(c_song, 'albumartist'),
+                                album=mpd.get_tag(c_song, 'album')))
+            if not songs:
+                songs = mpd.songset(mpd.find_multiple(
+                                    artist=mpd.get_tag(c_song, 'artist'),
+                                    album=mpd.get_tag(c_song, 'album')))
     else:
-        warning('Collection [{}] does not exist'.format(p[1]))
+        warning('Collection [{}] does not exist'.format(name))
         sys.exit(0)
+    return songs
 
 
-def p_expression_filter(p):
-    'expression : FILTER'
-    exact = True if p[1][0].isupper() else False
-    alias = (p[1][0] if p[1][1] in '"\'' else p[1][0:2]).lower()
-    name = filters_alias.get(alias, '')
-    pattern = p[1][2:-1] if p[1][1] in '"\'' else p[1][3:-1]
-    if not name:
-        warning('Filter [{}] does not exist'.format(alias))
-        sys.exit(0)
+def filter_songs(name, exact, pattern):
     if name == 'lastfm_a':
-        p[0] = OrderedSet()
+        songs = mpd.songset()
         if exact:
             artists = lastfm.find_artists(pattern)
         else:
             artists = lastfm.search_artists(pattern)
         for artist in artists:
-            p[0] |= mpd.find('artist', artist)
+            songs |= mpd.find('artist', artist)
     elif name == 'lastfm_b':
-        p[0] = OrderedSet()
+        songs = mpd.songset()
         if exact:
             albums = lastfm.find_albums(pattern)
         else:
@@ -173,10 +526,10 @@ def p_expression_filter(p):
             matched_songs = mpd.find_multiple(albumartist=artist, album=album)
             if not matched_songs:
                 matched_songs = mpd.find_multiple(artist=artist, album=album)
-            p[0] |= matched_songs
-        p[0] = mpd.set_sort(p[0])
+            songs |= matched_songs
+        songs = mpd.set_sort(songs)
     elif name == 'lastfm_t':
-        p[0] = OrderedSet()
+        songs = mpd.songset()
         if exact:
             tracks = lastfm.find_tracks(pattern)
         else:
@@ -185,71 +538,71 @@ def p_expression_filter(p):
             matched_songs = mpd.find_multiple(albumartist=artist, title=title)
             if not matched_songs:
                 matched_songs = mpd.find_multiple(artist=artist, title=title)
-            p[0] |= matched_songs
-        p[0] = mpd.set_sort(p[0])
+            songs |= matched_songs
+        songs = mpd.set_sort(songs)
     elif exact:
-        p[0] = OrderedSet(mpd.find(name, pattern))
+        songs = mpd.songset(mpd.find(name, pattern))
     else:
-        p[0] = OrderedSet(mpd.search(name, pattern))
+        songs = mpd.songset(mpd.search(name, pattern))
+    return songs
 
 
-def p_expression_operations(p):
-    '''expression : expression UNION expression
-                  | expression INTERSECTION expression
-                  | expression COMPLEMENT expression
-                  | expression SYMMETRIC_DIFFERENCE expression'''
-    if p[2] == '+':
-        p[0] = p[1] | p[3]
-    elif p[2] == '.':
-        p[0] = p[1] & p[3]
-    elif p[2] == '-':
-        p[0] = p[1] - p[3]
-    elif p[2] == '%':
-        p[0] = p[1] ^ p[3]
+operators = {
+    'UNION': operator.or_,
+    'INTERSECTION': operator.and_,
+    'COMPLEMENT': operator.sub,
+    'SYMMETRIC_DIFFERENCE': operator.xor,
+}
+
+operators_symbols = {
+    'UNION': '+',
+    'INTERSECTION': '.',
+    'COMPLEMENT': '-',
+    'SYMMETRIC_DIFFERENCE': '%',
+}
 
 
-def p_expression_modifier(p):
-    'expression : expression MODIFIER'
-    modifier = (p[2][1:]).lstrip()
+def modify(operand, modifier):
 
     # Sorting modifier
     if modifier == 's':
-        p[0] = mpd.set_sort(p[1])
+        result = mpd.set_sort(operand)
 
     # N-random songs modifier
     elif re.match(r'^r[0-9]+$', modifier):
-        p[1] = exclude_songs(p[1])
+        operand = exclude_songs(operand)
         try:
-            p[0] = OrderedSet(random.sample(p[1], int(modifier[1:])))
+            result = mpd.songset(random.sample(list(operand),
+                                               int(modifier[1:])))
         except ValueError:
-            p[0] = p[1]
+            result = operand
 
     # N-random artists modifier
     elif re.match(r'^ra[0-9]+$', modifier):
-        p[1] = exclude_songs(p[1])
+        operand = exclude_songs(operand)
         artists = OrderedSet()
-        for song in p[1]:
+        for song in operand:
             artists.add(mpd.get_tag(song, 'artist'))
         try:
-            r_artists = OrderedSet(random.sample(artists, int(modifier[2:])))
+            r_artists = random.sample(list(artists), int(modifier[2:]))
         except ValueError:
-            p[0] = p[1]
+            result = operand
         else:
             songs = []
             for artist in r_artists:
                 songs.extend(mpd.find('artist', artist))
-            p[0] = OrderedSet([song for song in p[1] if song in songs])
+            result = operand.restrict(songs)
 
     # N-random albums modifier
     elif re.match(r'^rb[0-9]+$', modifier):
-        p[1] = exclude_songs(p[1])
+        operand = exclude_songs(operand)
         albums = OrderedSet()
-        for song in p[1]:
+        for song in operand:
             albums.add(mpd.get_tags(song, ('album', 'albumartist')))
         try:
-            r_albums = OrderedSet(random.sample(albums, int(modifier[2:])))
+            r_albums = random.sample(list(albums), int(modifier[2:]))
         except ValueError:
-            p[0] = p[1]
+            result = operand
         else:
             songs = []
             for album, artist in r_albums:
@@ -259,34 +612,35 @@ def p_expression_modifier(p):
                     matched_songs = mpd.find_multiple(album=album,
                                                       artist=artist)
                 songs.extend(matched_songs)
-            p[0] = OrderedSet([song for song in p[1] if song in songs])
+            result = operand.restrict(songs)
 
     # N-minutes-long modifier
     elif re.match(r'^d[0-9]+$', modifier):
-        p[1] = exclude_songs(p[1])
+        operand = exclude_songs(operand)
         total_duration = int(modifier[1:]) * 60
         d = 0
-        p[0] = OrderedSet()
-        p[1] = list(p[1])
-        random.shuffle(p[1])
-        for song in p[1]:
+        songs = []
+        operand = list(operand)
+        random.shuffle(operand)
+        for song in operand:
             if d < total_duration:
-                p[0].add(song)
-                d += int(mpd.get_tag(song, 'time'))
+                songs.append(song)
+                d += int(mpd.get_tag(song, 'time', empty='0'))
             else:
                 break
+        result = mpd.songset(songs)
 
     # N-similar artists modifier
     elif re.match(r'^i?sa[0-9]+$', modifier):
         include = True if modifier[0] == 'i' else False
         limit = int(modifier[3:] if include else modifier[2:])
         w_tags = collections.defaultdict(int)
-        for song in p[1]:
+        for song in operand:
             tags = lastfm.get_artist_tags(mpd.get_tag(song, 'artist'))
             for tag, w in tags.items():
                 w_tags[tag] += w
         if not w_tags:
-            p[0] = p[1] if include else OrderedSet()
+            result = operand if include else mpd.songset()
         else:
             songs = []
             for artist, score in lastfm.get_similar_artists(w_tags):
@@ -294,24 +648,24 @@ def p_expression_modifier(p):
                     break
                 matched_songs = mpd.find('artist', artist)
                 if not include:
-                    matched_songs = OrderedSet(matched_songs) - p[1]
+                    matched_songs = mpd.songset(matched_songs) - operand
                 if matched_songs:
                     songs.extend(matched_songs)
                     limit -= 1
-            p[0] = OrderedSet(songs)
+            result = mpd.songset(songs)
 
     # N-similar albums modifier
     elif re.match(r'^i?sb[0-9]+$', modifier):
         include = True if modifier[0] == 'i' else False
         limit = int(modifier[3:] if include else modifier[2:])
         w_tags = collections.defaultdict(int)
-        for song in p[1]:
+        for song in operand:
             tags = lastfm.get_album_tags(mpd.get_tag(song, 'album'),
                                          mpd.get_tag(song, 'albumartist'))
             for tag, w in tags.items():
                 w_tags[tag] += w
         if not w_tags:
-            p[0] = p[1] if include else OrderedSet()
+            result = operand if include else mpd.songset()
         else:
             songs = []
             for (album, artist), score in lastfm.get_similar_albums(w_tags):
@@ -323,26 +677,156 @@ def p_expression_modifier(p):
                     matched_songs = mpd.find_multiple(album=album,
                                                       artist=artist)
                 if not include:
-                    matched_songs = OrderedSet(matched_songs) - p[1]
+                    matched_songs = mpd.songset(matched_songs) - operand
                 if matched_songs:
                     songs.extend(matched_songs)
                     limit -= 1
-            p[0] = OrderedSet(songs)
+            result = mpd.songset(songs)
 
     else:
         warning('Modifier [{}] does not exist'.format(modifier))
         sys.exit(0)
+    return result
 
 
-def p_expression_parenthesized(p):
-    'expression : LPAREN expression RPAREN'
-    p[0] = p[2]
-
-
-def p_error(t):
-    warning('Syntax error')
-    sys.exit(0)
-
+# --------------------------------
+# Collections evaluation
+# --------------------------------
 
-parser = yacc.yacc(debug=0, outputdir='/tmp/')
-# parser.parse(<collection>) will return a set of filenames
+# a stored collection is evaluated once per run, until the collections or
+# the state of MPD change (collectionsmanager.generation), except when it
+# depends on random modifiers: each reference is then a new draw. The
+# references between collections are read from the syntax trees of their
+# expressions, so that cycles are reported before anything is evaluated.
+#
+# results of the collections which only depend on the database and on the
+# collections file are also kept on disk by collectionsmanager, under a key
+# made of the database version, the collections file version, the
+# definition of the collection and the keys of its dependencies
+
+# collections depending on the playlist or the current song
+volatile_collections = ('c', 'C', 'A', 'B')
+
+
+class CollectionsEvaluator:
+
+    def __init__(self):
+        self.generation = None
+        self.reset()
+
+    def reset(self):
+        self.results = {}
+        self.graph = {}
+        self.acyclic = set()
+        self.random = {}
+        self.keys = {}
+        self.version = None
+
+    def check_generation(self):
+        if self.generation != collectionsmanager.generation:
+            self.generation = collectionsmanager.generation
+            self.reset()
+
+    def dependencies(self, alias):
+        # (collections referenced by alias, uses random modifiers, depends
+        # on something else than the database and the collections file)
+        if alias not in self.graph:
+            collection = collectionsmanager.c[alias]
+            dependencies = []
+            uses_random = False
+            volatile = 'command' in collection
+            tree = EMPTY
+            if 'expression' in collection:
+                tree = parser.syntax_tree(collection['expression'])
+            for node in descendants(tree):
+                names = []
+                if node[0] == 'collection':
+                    names = [node[1]]
+                    if (node[1] in volatile_collections and
+                        node[1] not in collectionsmanager.c):
+                        volatile = True
+                elif node[0] == 'filter' and node[1].startswith('lastfm'):
+                    volatile = True
+                elif node[0] == 'modifier' and lastfm_modifier.match(node[1]):
+                    # similar artists and albums come from the last.fm cache
+                    volatile = True
+                elif node[0] == 'modifier' and random_modifier.match(node[1]):
+                    # random modifiers exclude the songs of "exclude"
+                    uses_random = True
+                    if 'special' in collectionsmanager.c.get('exclude', {}):
+                        names = ['exclude']
+                dependencies.extend(name for name in names if
+                                    name in collectionsmanager.c and
+                                    name not in dependencies)
+            self.graph[alias] = (dependencies, uses_random, volatile)
+        return self.graph[alias]
+
+    def find_cycle(self, alias, path=()):
+        if alias in path:
+            return path[path.index(alias):] + (alias,)
+        if alias not in self.acyclic:
+            for dependency in self.dependencies(alias)[0]:
+                cycle = self.find_cycle(dependency, path + (alias,))
+                if cycle:
+                    return cycle
+            self.acyclic.add(alias)
+        return None
+
+    def check_cycle(self, alias):
+        # before anything recurses through the references of alias
+        cycle = self.find_cycle(alias)
+        if cycle:
+            warning('Collections reference each other: ' +
+                    ' -> '.join('[{}]'.format(a) for a in cycle))
+            sys.exit(0)
+
+    def is_random(self, alias):
+        self.check_generation()
+        if alias not in self.random:
+            self.check_cycle(alias)
+            dependencies, uses_random, volatile = self.dependencies(alias)
+            self.random[alias] = uses_random or any(self.is_random(d) for d
+                                                    in dependencies)
+        return self.random[alias]
+
+    def key(self, alias):
+        # key of the result kept on disk, None if it must not be kept
+        self.check_generation()
+        if alias not in self.keys:
+            self.check_cycle(alias)
+            dependencies, uses_random, volatile = self.dependencies(alias)
+            keys = [self.key(d) for d in dependencies]
+            if uses_random or volatile or None in keys:
+                self.keys[alias] = None
+            else:
+                if self.version is None:
+                    db_update = None
+                    if cache.exists('songs_info_db_update'):
+                        db_update = cache.read('songs_info_db_update')
+                    self.version = (db_update,
+                                    mpd.get_song_index().library_size,
+                                    os.path.getmtime(collectionsmanager.path))
+                definition = sorted(collectionsmanager.c[alias].items())
+                self.keys[alias] = hashlib.sha1(repr(
+                    (self.version, definition, keys)).encode()).hexdigest()
+        return self.keys[alias]
+
+    def evaluate(self, alias):
+        self.check_generation()
+        if alias in self.results:
+            return self.results[alias]
+        self.check_cycle(alias)
+        key = self.key(alias)
+        songs = None
+        if key is not None:
+            songs = collectionsmanager.get_result(alias, key)
+        if songs is None:
+            songs = collection_songs(alias)
+            if key is not None:
+                collectionsmanager.set_result(alias, key, songs)
+        if not self.is_random(alias):
+            self.results[alias] = songs
+        return songs
+
+
+evaluator = CollectionsEvaluator()
@@ -0,0 +1,148 @@
+# coding: utf-8
+import heapq
+import collections
+
+
+# --------------------------------
+# Local evaluation of MPD's find and search
+# --------------------------------
+
+# find matches the exact value of a tag, search does a case-insensitive
+# substring match, like MPD does. Indexes are built lazily, once per tag.
+
+class QueryEngine:
+
+    # song information MPD does not consider as tags for "any"
+    not_tags = ('time', 'duration', 'last-modified', 'format', 'added')
+
+    def __init__(self, songs_tags):
+        # songs_tags is a TagStore, values are indexed by their string id
+        # and only decoded once per distinct value
+        self.songs_tags = songs_tags
+        self.files = songs_tags.get_files()
+        self.exact_indexes = {}
+        self.lower_indexes = {}
+
+    def exact_index(self, tag):
+        # value -> positions in the library of the songs having this value
+        if tag not in self.exact_indexes:
+            if tag in ('file', 'filename'):
+                index = {filename: [i] for i, filename
+                         in enumerate(self.files)}
+            elif tag == 'any':
+                grouped = collections.defaultdict(list)
+                for key in ['file'] + self.songs_tags.tags:
+                    if key not in self.not_tags:
+                        for value, positions in self.exact_index(key).items():
+                            grouped[value].append(positions)
+                index = {value: merge(positions) for value, positions
+                         in grouped.items()}
+            else:
+                index = self.column_index(tag)
+            self.exact_indexes[tag] = index
+        return self.exact_indexes[tag]
+
+    def column_index(self, tag):
+        songs_tags = self.songs_tags
+        index = collections.defaultdict(list)
+        column = songs_tags.column(tag)
+        if column is not None:
+            offsets, values = column
+            for i in range(len(self.files)):
+                start, end = offsets[i], offsets[i + 1]
+                if end - start == 1:
+                    index[values[start]].append(i)
+                else:
+                    for value_id in set(values[start:end]):
+                        index[value_id].append(i)
+        if tag == 'albumartist':
+            # songs without albumartist are found by their artist
+            artists = collections.defaultdict(list)
+            for i in range(len(self.files)):
+                if column is None or column[0][i] == column[0][i + 1]:
+                    for value_id in set(songs_tags.value_ids(i, 'artist')):
+                        artists[value_id].append(i)
+            for value_id, positions in artists.items():
+                index[value_id] = merge([index[value_id], positions])
+        return {songs_tags.string(value_id): positions for value_id, positions
+                in index.items() if positions}
+
+    def lower_index(self, tag):
+        if tag not in self.lower_indexes:
+            index = collections.defaultdict(list)
+            for value, positions in self.exact_index(tag).items():
+                index[value.lower()].append(positions)
+            self.lower_indexes[tag] = {value: merge(positions) for value,
+                                       positions in index.items()}
+        return self.lower_indexes[tag]
+
+    def find_positions(self, tag, pattern):
+        return self.exact_index(tag).get(pattern, [])
+
+    def search_positions(self, tag, pattern):
+        pattern = pattern.lower()
+        return merge([positions for value, positions in
+                      self.lower_index(tag).items() if pattern in value])
+
+    def find(self, tag, pattern):
+        return [self.files[i] for i in self.find_positions(tag, pattern)]
+
+    def search(self, tag, pattern):
+        return [self.files[i] for i in self.search_positions(tag, pattern)]
+
+    def find_multiple(self, **filters):
+        return self.intersect([self.find_positions(tag, pattern)
+                               for tag, pattern in filters.items()])
+
+    def search_multiple(self, **filters):
+        return self.intersect([self.search_positions(tag, pattern)
+                               for tag, pattern in filters.items()])
+
+    def find_first(self, tags, values_list):
+        # file of the first song having the values of tags, for each tuple
+        # of values, None when no song has them. The songs having the first
+        # value (an album for instance) are found in its index, then checked
+        # against the other values, read from the columns
+        string = self.songs_tags.string
+        index = self.exact_index(tags[0])
+        columns = [self.songs_tags.column(tag) for tag in tags[1:]]
+        files = []
+        for values in values_list:
+            song_file = None
+            for i in index.get(values[0], ()):
+                for column, value in zip(columns, values[1:]):
+                    if column is None:
+                        break
+                    offsets, value_ids = column
+                    start, end = offsets[i], offsets[i + 1]
+                    if end - start == 1:
+                        if string(value_ids[start]) != value:
+                            break
+                    elif not any(string(value_ids[j]) == value
+                                 for j in range(start, end)):
+                        break
+                else:
+                    song_file = self.files[i]
+                    break
+            files.append(song_file)
+        return files
+
+    def intersect(self, positions_lists):
+        if not positions_lists:
+            return []
+        positions_lists.sort(key=len)
+        positions = set(positions_lists[0])
+        for other in positions_lists[1:]:
+            positions.intersection_update(other)
+        return [self.files[i] for i in sorted(positions)]
+
+
+def merge(positions_lists):
+    # sorted lists of positions -> sorted list without duplicates
+    if len(positions_lists) == 1:
+        return positions_lists[0]
+    positions = []
+    for position in heapq.merge(*positions_lists):
+        if not positions or positions[-1] != position:
+            positions.append(position)
+    return positions
@@ -0,0 +1,218 @@
+# coding: utf-8
+import collections.abc
+from array import array
+
+
+# --------------------------------
+# Song ids
+# --------------------------------
+
+# songs of the library get dense ids following the library order, files
+# which are not in the library (streams, output of a command...) get the
+# following ids when they are first seen
+
+class SongIndex:
+
+    def __init__(self, files):
+        self.files = list(files)
+        self.ids = {filename: i for i, filename in enumerate(self.files)}
+        self.library_size = len(self.files)
+        self.library_bits = (1 << self.library_size) - 1
+
+    def id(self, filename):
+        song_id = self.ids.get(filename)
+        if song_id is None:
+            song_id = self.ids[filename] = len(self.files)
+            self.files.append(filename)
+        return song_id
+
+    def all(self):
+        if not self.library_bits:
+            return SongSet(self, 0, [])
+        return SongSet(self, self.library_bits, [(self.library_bits, None)])
+
+    def songset(self, files=()):
+        if isinstance(files, SongSet) and files.index is self:
+            return files
+        return self.from_ids([self.id(filename) for filename in files])
+
+    def from_ids(self, ids):
+        data = bytearray(len(self.files) // 8 + 1)
+        order = array('I')
+        ascending = True
+        for song_id in ids:
+            bit = 1 << (song_id & 7)
+            if not data[song_id >> 3] & bit:
+                data[song_id >> 3] |= bit
+                if order and song_id < order[-1]:
+                    ascending = False
+                order.append(song_id)
+        bits = int.from_bytes(data, 'little')
+        if not bits:
+            return SongSet(self, 0, [])
+        return SongSet(self, bits, [(bits, None if ascending else order)])
+
+
+# --------------------------------
+# Sets of songs
+# --------------------------------
+
+# a SongSet is a bitset (an int whose bit i is set when the song i is in the
+# set), so that set operations work on whole machine words. The order of the
+# songs is kept apart as a list of disjoint segments (bits, order): order is
+# None when the songs of the segment follow the library order, else it is
+# the array of their ids. Like OrderedSet, a | b lists a then b, a & b
+# follows the order of b, a - b and a ^ b follow a then b.
+
+class SongSet(collections.abc.Set):
+
+    __slots__ = ('index', 'bits', 'segments')
+
+    def __init__(self, index, bits, segments):
+        self.index = index
+        self.bits = bits
+        self.segments = segments
+
+    def coerce(self, other):
+        if isinstance(other, SongSet) and other.index is self.index:
+            return other
+        return self.index.songset(other)
+
+    def __len__(self):
+        return popcount(self.bits)
+
+    def __bool__(self):
+        return self.bits != 0
+
+    def __contains__(self, filename):
+        song_id = self.index.ids.get(filename)
+        return song_id is not None and self.bits >> song_id & 1 == 1
+
+    def __iter__(self):
+        files = self.index.files
+        for bits, order in self.segments:
+            for song_id in (bits_to_ids(bits) if order is None else order):
+                yield files[song_id]
+
+    def __reversed__(self):
+        return reversed(list(self))
+
+    def __repr__(self):
+        return '{}({!r})'.format(self.__class__.__name__, list(self))
+
+    def __or__(self, other):
+        other = self.coerce(other)
+        return SongSet(self.index, self.bits | other.bits, self.segments +
+                       filter_segments(other.segments, ~self.bits))
+
+    def __and__(self, other):
+        other = self.coerce(other)
+        return SongSet(self.index, self.bits & other.bits,
+                       filter_segments(other.segments, self.bits))
+
+    def __sub__(self, other):
+        other = self.coerce(other)
+        return SongSet(self.index, self.bits & ~other.bits,
+                       filter_segments(self.segments, ~other.bits))
+
+    def __xor__(self, other):
+        other = self.coerce(other)
+        return SongSet(self.index, self.bits ^ other.bits,
+                       filter_segments(self.segments, ~other.bits) +
+                       filter_segments(other.segments, ~self.bits))
+
+    def __ror__(self, other):
+        return self.coerce(other) | self
+
+    def __rand__(self, other):
+        return self.coerce(other) & self
+
+    def __rsub__(self, other):
+        return self.coerce(other) - self
+
+    def __rxor__(self, other):
+        return self.coerce(other) ^ self
+
+    def __eq__(self, other):
+        if isinstance(other, SongSet) and other.index is self.index:
+            return self.bits == other.bits
+        return super().__eq__(other)
+
+    def __le__(self, other):
+        other = self.coerce(other)
+        return self.bits & ~other.bits == 0
+
+    def __ge__(self, other):
+        other = self.coerce(other)
+        return other.bits & ~self.bits == 0
+
+    __hash__ = None
+
+    issubset = __le__
+    issuperset = __ge__
+
+    def restrict(self, other):
+        # songs also in other, keeping the order of self
+        other = self.coerce(other)
+        return SongSet(self.index, self.bits & other.bits,
+                       filter_segments(self.segments, other.bits))
+
+    def sorted(self):
+        # songs of the library only, in the library order. The ids are the
+        # positions in the library: the ids of a small set are sorted, so
+        # that iterating it does not scan a bitset as wide as the library
+        bits = self.bits & self.index.library_bits
+        if not bits:
+            return SongSet(self.index, 0, [])
+        if (all(order is None for _, order in self.segments) or
+            popcount(bits) * sparse_ratio > self.index.library_size):
+            return SongSet(self.index, bits, [(bits, None)])
+        ids = []
+        for segment_bits, order in filter_segments(self.segments, bits):
+            ids.extend(bits_to_ids(segment_bits) if order is None else order)
+        ids.sort()
+        return SongSet(self.index, bits, [(bits, array('I', ids))])
+
+
+# --------------------------------
+# Bits helpers
+# --------------------------------
+
+# sets with less than library size / sparse_ratio songs keep their order as
+# an array of ids rather than as the bits
+sparse_ratio = 32
+
+# int.bit_count is new in Python 3.10
+popcount = getattr(int, 'bit_count', lambda bits: bin(bits).count('1'))
+
+BYTE_BITS = [tuple(i for i in range(8) if byte >> i & 1)
+             for byte in range(256)]
+
+
+def bits_to_ids(bits):
+    ids = []
+    data = bits.to_bytes((bits.bit_length() + 7) // 8, 'little')
+    for offset, byte in enumerate(data):
+        if byte:
+            base = offset << 3
+            for i in BYTE_BITS[byte]:
+                ids.append(base + i)
+    return ids
+
+
+def filter_segments(segments, mask):
+    filtered = []
+    for bits, order in segments:
+        kept = bits & mask
+        if not kept:
+            continue
+        if kept == bits:
+            filtered.append((bits, order))
+        elif order is None:
+            filtered.append((kept, None))
+        else:
+            data = kept.to_bytes((kept.bit_length() + 7) // 8, 'little')
+            filtered.append((kept, array('I', (i for i in order if
+                                               i >> 3 < len(data) and
+                                               data[i >> 3] >> (i & 7) & 1))))
+    return filtered
@@ -0,0 +1,122 @@
+# coding: utf-8
+import os
+import sys
+import json
+import time
+import atexit
+import contextlib
+import collections
+
+
+# --------------------------------
+# Instrumentation
+# --------------------------------
+
+# counters and timing histograms of the requests sent to MPD, the cache
+# reads and writes, the last.fm requests and the subprocesses. Disabled by
+# default, enabled by the MPDC_STATS environment variable or the --stats
+# option: "1" prints a summary on stderr at exit, another value is the path
+# of a file to which the summary is appended as a line of JSON.
+
+class Stats:
+
+    # upper bounds of the buckets of the histograms, in seconds
+    buckets = (0.001, 0.01, 0.1, 1, 10)
+
+    def __init__(self):
+        self.enabled = False
+        self.output = None
+        self.start = time.time()
+        self.counters = collections.Counter()
+        # name -> [count, total time, max time, count of each bucket]
+        self.timings = {}
+
+    def enable(self, output='1'):
+        if not self.enabled:
+            atexit.register(self.report)
+        self.enabled = True
+        self.output = output
+
+    def count(self, name, n=1):
+        if self.enabled:
+            self.counters[name] += n
+
+    def add_time(self, name, elapsed):
+        timing = self.timings.get(name)
+        if timing is None:
+            timing = self.timings[name] = [0, 0, 0,
+                                           [0] * (len(self.buckets) + 1)]
+        timing[0] += 1
+        timing[1] += elapsed
+        timing[2] = max(timing[2], elapsed)
+        bucket = 0
+        while bucket < len(self.buckets) and elapsed >= self.buckets[bucket]:
+            bucket += 1
+        timing[3][bucket] += 1
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def bucket_names(self):
+        names = ['<' + format_seconds(bound) for bound in self.buckets]
+        return names + ['>=' + format_seconds(self.buckets[-1])]
+
+    def summary(self):
+        timings = collections.OrderedDict()
+        for name, (count, total, maximum, histogram) in \
+                sorted(self.timings.items()):
+            timings[name] = collections.OrderedDict([
+                ('count', count), ('total', total), ('max', maximum),
+                ('histogram', collections.OrderedDict(
+                    zip(self.bucket_names(), histogram)))])
+        return collections.OrderedDict([
+            ('time', self.start), ('argv', sys.argv[1:]),
+            ('elapsed', time.time() - self.start),
+            ('counters', collections.OrderedDict(sorted(
+                self.counters.items()))),
+            ('timings', timings)])
+
+    def report(self):
+        summary = self.summary()
+        if self.output != '1':
+            try:
+                with open(os.path.expanduser(self.output), 'a') as f:
+                    f.write(json.dumps(summary) + '\n')
+            except IOError:
+                print('Cannot write the stats in: ' + self.output,
+                      file=sys.stderr)
+            return
+        lines = ['mpdc stats, {:.1f} ms'.format(summary['elapsed'] * 1000)]
+        if summary['timings']:
+            lines.append('{:24} {:>6} {:>10} {:>9} '.format(
+                         '', 'count', 'total ms', 'max ms') +
+                         ' '.join('{:>6}'.format(name)
+                                  for name in self.bucket_names()))
+            for name, timing in summary['timings'].items():
+                lines.append('{:24} {:>6} {:>10.1f} {:>9.1f} '.format(
+                             name, timing['count'], timing['total'] * 1000,
+                             timing['max'] * 1000) +
+                             ' '.join('{:>6}'.format(n) for n
+                                      in timing['histogram'].values()))
+        for name, count in summary['counters'].items():
+            lines.append('{:24} {:>6}'.format(name, count))
+        print('\n'.join(lines), file=sys.stderr)
+
+
+def format_seconds(seconds):
+    return '{:g}ms'.format(seconds * 1000) if seconds < 1 else \
+        '{:g}s'.format(seconds)
+
+
+stats = Stats()
+
+if os.environ.get('MPDC_STATS'):
+    stats.enable(os.environ['MPDC_STATS'])
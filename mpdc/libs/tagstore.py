@@ -0,0 +1,248 @@
+# coding: utf-8
+import sys
+import mmap
+import struct
+import collections.abc
+from array import array
+
+
+# --------------------------------
+# Songs tags store
+# --------------------------------
+
+# binary format of the songs cache: a table of unique strings and, for each
+# tag, a column giving the ids of the values of every song. Everything is
+# read lazily from a memory-mapped file: a command only decodes the columns
+# and the strings it uses.
+#
+#   header     magic, version, byte order, number of songs and of sections
+#   directory  for each section: name, offset and length in the file
+#   sections   'strings.offsets', 'strings.data': offsets of the strings in
+#              the utf-8 data, 'files': string id of the file of each song,
+#              'offsets.<tag>', 'values.<tag>': the values of the song i are
+#              values[offsets[i]:offsets[i + 1]]
+#
+# integers are unsigned 32 bits integers in the byte order of the machine
+# which wrote the file, files written with another byte order are rejected
+
+MAGIC = b'MPDCTAGS'
+VERSION = 1
+
+HEADER = struct.Struct('<8sHHII')
+SECTION = struct.Struct('<QQ')
+BYTE_ORDERS = {'little': 1, 'big': 2}
+
+UINT32 = next(typecode for typecode in 'ILH' if array(typecode).itemsize == 4)
+
+
+class TagStore(collections.abc.Mapping):
+
+    use_mmap = True
+
+    def __init__(self, data):
+        self.data = data
+        self.view = memoryview(data)
+        try:
+            magic, version, byte_order, self.size, sections = \
+                HEADER.unpack_from(data, 0)
+        except struct.error:
+            raise ValueError('Truncated header')
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('Unknown format or version')
+        if byte_order != BYTE_ORDERS[sys.byteorder]:
+            raise ValueError('Written with another byte order')
+        # a truncated or corrupt file raises ValueError, like a missing one
+        # it is then written again
+        self.sections = {}
+        position = HEADER.size
+        for i in range(sections):
+            if position + 2 > len(data):
+                raise ValueError('Truncated directory')
+            name_length, = struct.unpack_from('<H', data, position)
+            position += 2
+            if position + name_length + SECTION.size > len(data):
+                raise ValueError('Truncated directory')
+            name = bytes(self.view[position:position + name_length]).decode(
+                'utf-8', 'replace')
+            position += name_length
+            self.sections[name] = SECTION.unpack_from(data, position)
+            position += SECTION.size
+        for name in ('strings.offsets', 'strings.data', 'files'):
+            if name not in self.sections:
+                raise ValueError('Missing section')
+        for name, (offset, length) in self.sections.items():
+            if offset + length > len(data):
+                raise ValueError('Truncated section')
+            if name != 'strings.data' and length % 4:
+                raise ValueError('Corrupt section')
+        if self.sections['files'][1] != self.size * 4:
+            raise ValueError('Corrupt section')
+        for name, (offset, length) in self.sections.items():
+            if (name.startswith('offsets.') and
+                length != (self.size + 1) * 4 or
+                name.startswith('values.') and
+                'offsets.' + name[7:] not in self.sections):
+                raise ValueError('Corrupt section')
+
+        self.tags = [name[7:] for name in self.sections
+                     if name.startswith('values.')]
+        self.strings_offsets = self.section('strings.offsets')
+        self.strings_data = self.section('strings.data', cast=False)
+        self.strings = {}
+        self.columns = {}
+        self.files = None
+        self.rows = None
+
+    @classmethod
+    def open(cls, path):
+        with open(path, 'rb') as f:
+            if cls.use_mmap:
+                try:
+                    data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                except ValueError:
+                    # empty file
+                    data = b''
+            else:
+                data = f.read()
+        return cls(data)
+
+    def section(self, name, cast=True):
+        offset, length = self.sections[name]
+        view = self.view[offset:offset + length]
+        return view.cast(UINT32) if cast else view
+
+    def string(self, string_id):
+        string = self.strings.get(string_id)
+        if string is None:
+            string = sys.intern(self.decode(string_id))
+            self.strings[string_id] = string
+        return string
+
+    def decode(self, string_id):
+        offsets = self.strings_offsets
+        return str(self.strings_data[offsets[string_id]:
+                   offsets[string_id + 1]], 'utf-8', 'surrogateescape')
+
+    def column(self, tag):
+        # (offsets, values) of a tag, None if no song has it
+        if tag not in self.columns:
+            if 'values.' + tag in self.sections:
+                self.columns[tag] = (self.section('offsets.' + tag),
+                                     self.section('values.' + tag))
+            else:
+                self.columns[tag] = None
+        return self.columns[tag]
+
+    def get_files(self):
+        if self.files is None:
+            # files are unique, they are not kept in the strings cache
+            self.files = [self.decode(i) for i in self.section('files')]
+        return self.files
+
+    def row(self, filename):
+        if self.rows is None:
+            self.rows = {f: i for i, f in enumerate(self.get_files())}
+        return self.rows.get(filename)
+
+    def value_ids(self, row, tag):
+        column = self.column(tag)
+        if column is None:
+            return ()
+        offsets, values = column
+        return values[offsets[row]:offsets[row + 1]]
+
+    def tag_values(self, filename, tag):
+        row = self.row(filename)
+        if row is None:
+            return []
+        return [self.string(i) for i in self.value_ids(row, tag)]
+
+    def song(self, row):
+        song = {}
+        for tag in self.tags:
+            values = [self.string(i) for i in self.value_ids(row, tag)]
+            if values:
+                song[tag] = values[0] if len(values) == 1 else values
+        return song
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        return iter(self.get_files())
+
+    def __contains__(self, filename):
+        return self.row(filename) is not None
+
+    def __getitem__(self, filename):
+        row = self.row(filename)
+        if row is None:
+            raise KeyError(filename)
+        return self.song(row)
+
+
+class TagStoreWriter:
+
+    def __init__(self):
+        self.size = 0
+        self.string_ids = {}
+        self.files = array(UINT32)
+        self.columns = {}
+
+    def string_id(self, string):
+        string_id = self.string_ids.get(string)
+        if string_id is None:
+            string_id = self.string_ids[string] = len(self.string_ids)
+        return string_id
+
+    def add(self, filename, song):
+        self.files.append(self.string_id(filename))
+        for tag, values in song.items():
+            if tag not in self.columns:
+                # songs added before had no value for this tag
+                self.columns[tag] = (array(UINT32, [0] * (self.size + 1)),
+                                     array(UINT32))
+            if not isinstance(values, (list, tuple)):
+                values = (values,)
+            self.columns[tag][1].extend(self.string_id(v) for v in values)
+        self.size += 1
+        for offsets, values in self.columns.values():
+            offsets.append(len(values))
+
+    def chunks(self):
+        # the file as a sequence of bytes-like chunks, one per section, so
+        # that it is written without being assembled in memory
+        strings_offsets = array(UINT32, [0])
+        strings_data = bytearray()
+        for string in self.string_ids:
+            strings_data += string.encode('utf-8', 'surrogateescape')
+            strings_offsets.append(len(strings_data))
+        sections = [('strings.offsets', strings_offsets),
+                    ('strings.data', strings_data),
+                    ('files', self.files)]
+        for tag, (offsets, values) in self.columns.items():
+            sections.append(('offsets.' + tag, offsets))
+            sections.append(('values.' + tag, values))
+
+        names = [name.encode() for name, content in sections]
+        position = HEADER.size + sum(2 + len(name) + SECTION.size
+                                     for name in names)
+        directory = bytearray()
+        paddings = []
+        for name, (_, content) in zip(names, sections):
+            # sections are aligned on 8 bytes
+            paddings.append(-position % 8)
+            position += paddings[-1]
+            length = len(memoryview(content).cast('B'))
+            directory += struct.pack('<H', len(name)) + name
+            directory += SECTION.pack(position, length)
+            position += length
+        yield HEADER.pack(MAGIC, VERSION, BYTE_ORDERS[sys.byteorder],
+                          self.size, len(sections))
+        yield directory
+        for padding, (_, content) in zip(paddings, sections):
+            yield bytes(padding)
+            yield content
+
+    def to_bytes(self):
+        return b''.join(self.chunks())
@@ -1,10 +1,21 @@
 # coding: utf-8
 import os
+import sys
+import zlib
 import math
-import curses
+import bisect
+import fcntl
+import shlex
+import struct
 import pickle
+import shutil
+import threading
+import contextlib
 import subprocess
-import collections
+import collections.abc
+
+from mpdc.libs.tagstore import TagStore
+from mpdc.libs.stats import stats
 
 
 # --------------------------------
@@ -14,8 +25,17 @@ import collections
 class Cache:
     cache_path = os.path.expanduser('~/.cache/mpdc/{profile}/{name}.mpdc')
 
+    # pickles are preceded by a header: magic, version of the format, length
+    # and checksum of the pickle, a file which does not match is ignored
+    header = struct.Struct('<4sHQI')
+    magic = b'MPDC'
+    version = 1
+
     def __init__(self, profile):
         self.p = Cache.cache_path.format(profile=profile, name='{name}')
+        self.lock_file = None
+        self.lock_depth = 0
+        self.thread_lock = threading.RLock()
 
     def exists(self, name):
         return os.path.isfile(self.p.format(name=name))
@@ -23,24 +43,90 @@ class Cache:
     def last_modified(self, name):
         return os.path.getmtime(self.p.format(name=name))
 
+    def makedirs(self):
+        if not os.path.exists(os.path.dirname(self.p)):
+            os.makedirs(os.path.dirname(self.p))
+
+    @contextlib.contextmanager
+    def lock(self):
+        # advisory lock of the profile, for the sections which check then
+        # rewrite caches; reentrant within a process
+        with self.thread_lock:
+            if self.lock_depth == 0:
+                try:
+                    self.makedirs()
+                    self.lock_file = open(self.p.format(name='lock'), 'a')
+                    fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+                except IOError:
+                    warning('Cannot lock the cache in: ' +
+                            os.path.dirname(self.p))
+            self.lock_depth += 1
+            try:
+                yield
+            finally:
+                self.lock_depth -= 1
+                if self.lock_depth == 0 and self.lock_file is not None:
+                    self.lock_file.close()
+                    self.lock_file = None
+
     def read(self, name, **kwargs):
+        # we want new empty dict as default for each call
+        default = kwargs.get('default', dict())
+        with stats.timer('cache.read'):
+            return self.read_pickle(name, default)
+
+    def read_pickle(self, name, default):
         try:
             with open(self.p.format(name=name), 'rb') as f:
-                return pickle.load(f)
+                data = f.read()
         except IOError:
+            stats.count('cache.miss')
             warning('Cannot read cache from: ' + self.p.format(name=name))
-            # we want new empty dict as default for each call
-            return kwargs.get('default', dict())
-
-    def write(self, name, data):
+            return default
+        try:
+            if data[:len(self.magic)] == self.magic:
+                magic, version, length, checksum = \
+                    self.header.unpack_from(data)
+                data = data[self.header.size:]
+                if (version != self.version or length != len(data) or
+                    checksum != zlib.crc32(data)):
+                    raise ValueError('Invalid header')
+            # else a pickle written by a former version, without header
+            data = pickle.loads(data)
+        except Exception:
+            stats.count('cache.invalid')
+            warning('Invalid cache ignored: ' + self.p.format(name=name))
+            return default
+        stats.count('cache.hit')
+        return data
+
+    def read_store(self, name):
+        # None when the store is missing or in an older format
         try:
-            if not os.path.exists(os.path.dirname(self.p)):
-                os.makedirs(os.path.dirname(self.p))
-            with open(self.p.format(name=name), 'wb') as f:
-                pickle.dump(data, f)
+            with stats.timer('cache.read_store'):
+                store = TagStore.open(self.p.format(name=name))
+        except (IOError, ValueError):
+            stats.count('cache.miss')
+            return None
+        stats.count('cache.hit')
+        return store
+
+    def write_bytes(self, name, data):
+        try:
+            self.makedirs()
+            with stats.timer('cache.write'):
+                atomic_write(self.p.format(name=name), data)
+            stats.count('cache.bytes_written',
+                        os.path.getsize(self.p.format(name=name)))
         except IOError:
             warning('Cannot write cache in: ' + self.p.format(name=name))
 
+    def write(self, name, data):
+        data = pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+        self.write_bytes(name, self.header.pack(self.magic, self.version,
+                                                len(data), zlib.crc32(data))
+                         + data)
+
 
 # --------------------------------
 # Colors functions
@@ -66,6 +152,13 @@ def info(s):
     print(colorize('[info] ', 'green', bold=True) + s)
 
 
+def progress(done, total):
+    if sys.stdout.isatty():
+        end = '\n' if done >= total else ''
+        print('\r' + colorize('[info] ', 'green', bold=True) +
+              '{}/{}'.format(done, total), end=end, flush=True)
+
+
 # --------------------------------
 # Columns width
 # --------------------------------
@@ -83,8 +176,7 @@ columns_w = {
 
 
 def columns_width(columns):
-    curses.setupterm()
-    term_w = curses.tigetnum('cols')
+    term_w = shutil.get_terminal_size().columns
     t_w = sum(columns_w[column] for column in columns)
     c_w = {column: int(term_w * columns_w[column] / t_w) for column in columns}
     return c_w, term_w
@@ -113,15 +205,78 @@ def repr_tags(tags):
     return ', '.join(['"' + esc_quotes(tag) + '"' for tag in tags])
 
 
+def atomic_write(path, data):
+    # written aside then renamed, so that readers (and memory-mapped stores)
+    # see either the old or the new file, never a partial one. data is bytes,
+    # a string or an iterable of strings or of bytes-like chunks, written as
+    # it is produced
+    path = os.path.realpath(path)
+    temp_path = '{}.{}.tmp'.format(path, os.getpid())
+    if isinstance(data, (bytes, str)):
+        data = (data,)
+    data = iter(data)
+    first = next(data, b'')
+    try:
+        with open(temp_path, 'w' if isinstance(first, str) else 'wb') as f:
+            f.write(first)
+            f.writelines(data)
+            f.flush()
+            os.fsync(f.fileno())
+        if os.path.exists(path):
+            shutil.copymode(path, temp_path)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        raise
+
+
+def longest_increasing_subsequence(values):
+    # indices of a longest strictly increasing subsequence of values
+    tails = []
+    tails_values = []
+    predecessors = [None] * len(values)
+    for i, value in enumerate(values):
+        length = bisect.bisect_left(tails_values, value)
+        if length > 0:
+            predecessors[i] = tails[length - 1]
+        if length == len(tails):
+            tails.append(i)
+            tails_values.append(value)
+        else:
+            tails[length] = i
+            tails_values[length] = value
+    indices = []
+    i = tails[-1] if tails else None
+    while i is not None:
+        indices.append(i)
+        i = predecessors[i]
+    return indices[::-1]
+
+
 def format_mpc_output(raw):
     return [line for line in raw.split('\n') if line]
 
 
+def page(text, pager):
+    # a daemon request is paged by the client, on its own terminal
+    if hasattr(sys.stdout, 'page'):
+        sys.stdout.page(text, pager)
+    else:
+        with stats.timer('subprocess.pager'):
+            pager_p = subprocess.Popen(shlex.split(pager),
+                                       stdin=subprocess.PIPE)
+            pager_p.stdin.write(bytes(text, 'utf-8'))
+            pager_p.stdin.close()
+            pager_p.communicate()
+
+
 def input_box(title, message):
     try:
-        data = subprocess.check_output(['zenity', '--title=' + title,
-                                        '--entry', '--text=' + message,
-                                        '--width', '500'])
+        with stats.timer('subprocess.zenity'):
+            data = subprocess.check_output(['zenity', '--title=' + title,
+                                            '--entry', '--text=' + message,
+                                            '--width', '500'])
     except subprocess.CalledProcessError:
         return None
     return data.decode().strip()
@@ -132,7 +287,7 @@ def input_box(title, message):
 # From http://code.activestate.com/recipes/576694/
 # --------------------------------
 
-class OrderedSet(collections.MutableSet):
+class OrderedSet(collections.abc.MutableSet):
     def __init__(self, iterable=None):
         self.end = end = []
         end += [None, end, end]         # sentinel node for doubly linked list
@@ -0,0 +1,61 @@
+# coding: utf-8
+import time
+import threading
+
+import mpd
+
+
+# --------------------------------
+# MPD idle watcher
+# --------------------------------
+
+# waits for MPD to report changes on its own connection (idle blocks it) and
+# calls callback(subsystems) with the changed subsystems, or callback(None)
+# after a reconnection since changes may have been missed. Errors of its
+# connection are retried, after an error of the callback the watcher calls
+# stopped() and ends
+
+class IdleWatcher(threading.Thread):
+
+    subsystems = ('database', 'stored_playlist', 'playlist', 'player')
+    retry_delay = 5
+
+    def __init__(self, host, port, password, callback, stopped=None):
+        super().__init__(daemon=True)
+        self.host = host
+        self.port = port
+        self.password = password
+        self.callback = callback
+        self.stopped = stopped
+        self.mpdclient = None
+
+    def connect(self):
+        self.mpdclient = mpd.MPDClient()
+        self.mpdclient.connect(self.host, self.port)
+        if self.password:
+            self.mpdclient.password(self.password)
+
+    def run(self):
+        reconnecting = False
+        while True:
+            try:
+                if self.mpdclient is None:
+                    self.connect()
+                    if not reconnecting:
+                        continue
+                    # changes may have been missed while disconnected
+                    changed = None
+                else:
+                    changed = set(self.mpdclient.idle(*self.subsystems))
+            except (mpd.ConnectionError, OSError):
+                self.mpdclient = None
+                reconnecting = True
+                time.sleep(self.retry_delay)
+                continue
+            try:
+                self.callback(changed)
+            except (Exception, SystemExit):
+                # e.g. the collections file cannot be read anymore
+                if self.stopped is not None:
+                    self.stopped()
+                return
@@ -1,30 +1,39 @@
-
 import sys
 
+from mpdc.libs import daemon
+from mpdc.libs.stats import stats
 from mpdc.libs.argparse_abbrev import AbbrevArgumentParser
 
-from mpdc import (
-    mpdc_playlist,
-    mpdc_collections,
-    mpdc_database,
-    mpdc_configure,
-    mpdc_mpc,
-)
-
-SUBPARSERS = (
-    ('playlist', mpdc_playlist, 'Actions on current mpd playlist'),
-    ('collections', mpdc_collections, 'Actions on collections'),
-    (('database', 'db'), mpdc_database, 'Actions on database'),
-    ('configure', mpdc_configure, 'Change, create configuration file or switch profile'),
-)
 
 MPC_COMMAND = ':'
 
-def main():
+parsers = None
+
+
+def setup_parsers():
+    # subcommands modules need an initialized mpdc, they are only imported
+    # when the command is not run by the daemon
+    from mpdc import (
+        mpdc_playlist,
+        mpdc_collections,
+        mpdc_database,
+        mpdc_configure,
+        mpdc_daemon,
+        mpdc_mpc,
+    )
+
+    subparsers_modules = (
+        ('playlist', mpdc_playlist, 'Actions on current mpd playlist'),
+        ('collections', mpdc_collections, 'Actions on collections'),
+        (('database', 'db'), mpdc_database, 'Actions on database'),
+        ('configure', mpdc_configure, 'Change, create configuration file or switch profile'),
+        ('daemon', mpdc_daemon, 'Start or stop the mpdc daemon'),
+    )
+
     argparser = AbbrevArgumentParser(add_help=False)
     subparsers = argparser.add_subparsers()
 
-    for cmd, module, help in SUBPARSERS:
+    for cmd, module, help in subparsers_modules:
         if isinstance(cmd, tuple):
             subparser = subparsers.add_parser(cmd[0], aliases=cmd[1:], help=help, priority='-')
         else:
@@ -34,8 +43,17 @@ def main():
     # can't find an argparse-way solution for this (mpc colon):
     mpc_parser = AbbrevArgumentParser(add_help=False)
     mpdc_mpc.setup_args(mpc_parser)
+    return argparser, mpc_parser
+
+
+def run(argv, forwarded=False):
+    # returns False if a forwarded command has to run in the client
+    global parsers
+    if parsers is None:
+        parsers = setup_parsers()
+    argparser, mpc_parser = parsers
+
     mpc_argv = None
-    argv = sys.argv[1:] # exclude executable name
     # if MPC_COMMAND passed, split argv on before it and after it.
     # First part goes to main parser, mpc part gets splitted and goes to mpc parser
     if MPC_COMMAND in argv:
@@ -54,6 +72,8 @@ def main():
             break
 
     parsed = argparser.parse_args(argv)
+    if forwarded and getattr(parsed, 'local', False):
+        return False
     if 'func' in parsed:
         parsed.func(parsed)
     elif not mpc_argv_lists:
@@ -66,6 +86,21 @@ def main():
         else:
             mpc_parser.print_help()
             break
+    return True
+
+
+def main():
+    argv = sys.argv[1:] # exclude executable name
+    # --stats or --stats=FILE, before the subcommand: see mpdc.libs.stats
+    while argv and argv[0].split('=')[0] == '--stats':
+        stats.enable(argv.pop(0).partition('=')[2] or '1')
+    # a running daemon saves the initialization of mpdc, but the stats are
+    # those of this process
+    code = None if stats.enabled else daemon.forward(argv)
+    if code is None:
+        run(argv)
+    else:
+        sys.exit(code)
 
 
 if __name__ == '__main__':
@@ -1,6 +1,7 @@
 # coding: utf-8
 import os
 import sys
+import json
 import shlex
 import argparse
 import subprocess
@@ -8,8 +9,10 @@ import subprocess
 from mpdc.initialize import mpd, collectionsmanager, lastfm, cache, colors, \
                             columns, enable_pager, pager
 from mpdc.libs.utils import esc_quotes, info, warning, colorize, \
-                            columns_width
-from mpdc.libs.parser import parser
+                            columns_width, page
+from mpdc.libs.parser import parser, evaluator
+from mpdc.libs.songset import bits_to_ids
+from mpdc.libs.stats import stats
 
 
 def display_songs(filenames, path=None, enable_pager=False):
@@ -36,7 +39,7 @@ def display_songs(filenames, path=None, enable_pager=False):
                     tag = song
                 else:
                     tag = mpd.get_tag(song, column, empty='<empty>')
-                    if column == 'time':
+                    if column == 'time' and tag.isdigit():
                         m, s = divmod(int(tag), 60)
                         tag = '{}:{:02}'.format(m, s)
                 if len(tag) > c_w[column] - 1:
@@ -53,10 +56,7 @@ def display_songs(filenames, path=None, enable_pager=False):
             else:
                 print(os.path.join(path, song))
     if enable_pager:
-        pager_p = subprocess.Popen(shlex.split(pager), stdin=subprocess.PIPE)
-        pager_p.stdin.write(bytes('\n'.join(lines), 'utf-8'))
-        pager_p.stdin.close()
-        pager_p.communicate()
+        page('\n'.join(lines), pager)
 
 
 def format_alias(alias):
@@ -69,6 +69,18 @@ def format_alias(alias):
     return alias
 
 
+def display_profile(entry, depth=0):
+    # one line per node of the evaluated tree, children indented below
+    node = '  ' * depth + entry['node']
+    if entry['cached']:
+        node += ' (cached)'
+    print('{:40} {:>10.2f} ms {:>8} songs {:>6} requests {:>10.1f} KiB'.format(
+          node, entry['time'] * 1000, entry['songs'], entry['round_trips'],
+          entry['bytes'] / 1024))
+    for child in entry['children']:
+        display_profile(child, depth + 1)
+
+
 # --------------------------------
 # Program functions
 # --------------------------------
@@ -77,6 +89,12 @@ def ls(args):
     if args.collection is None:
         for alias in collectionsmanager.c:
             print(format_alias(alias))
+    elif args.profile or args.json:
+        songs, profile = parser.profile(args.collection)
+        if args.json:
+            print(json.dumps(profile, indent=2))
+        else:
+            display_profile(profile)
     else:
         songs = parser.parse(args.collection)
         display_songs(songs, args.f, (enable_pager or args.p) and not args.np)
@@ -107,7 +125,7 @@ def show(args):
 def check(args):
     # will print a warning if there is a problem
     print('Checking "songs" sections...')
-    collectionsmanager.feed(force=True)
+    collectionsmanager.feed(force=True, incremental=False)
     for alias, collection in collectionsmanager.c.items():
         if 'mpd_playlist' not in collection:
             print('Checking collection [{}]...'.format(alias))
@@ -115,24 +133,52 @@ def check(args):
 
 
 def find(args):
+    # collections whose result can be cached are looked up in the reverse
+    # index (evaluated first if their cached result is missing or outdated),
+    # the others are evaluated
+    for alias in collectionsmanager.c:
+        evaluator.check_cycle(alias)
+    for alias in collectionsmanager.c:
+        if evaluator.key(alias) is not None:
+            evaluator.evaluate(alias)
+    # results with songs outside the library (streams...) are not stored
+    others = [alias for alias in collectionsmanager.c
+              if evaluator.key(alias) is None or
+              collectionsmanager.get_result(alias, evaluator.key(alias))
+              is None]
+    reverse_index = collectionsmanager.get_reverse_index()
+    found = set()
     # assuming it's a file
-    if args.pattern in mpd.get_all_songs():
+    if args.pattern in mpd.get_all_songs_tags():
         print('File found in:')
         print('--------------')
-        for alias in collectionsmanager.c:
-            songs = parser.parse('"' + esc_quotes(alias) + '"')
-            if args.pattern in songs:
-                print(format_alias(alias))
+        song_id = mpd.get_song_index().id(args.pattern)
+        found.update(reverse_index.get(song_id, ()))
+        found.difference_update(others)
+        for alias in others:
+            if args.pattern in evaluator.evaluate(alias):
+                found.add(alias)
     # assuming it's a collection
     else:
-        songs = parser.parse(args.pattern)
+        songs = mpd.songset(parser.parse(args.pattern))
         print('Collection is a subset of:')
         print('--------------------------')
         if songs:
-            for alias in collectionsmanager.c:
-                s = parser.parse('"' + esc_quotes(alias) + '"')
-                if args.pattern.strip(' \'"') != alias and songs.issubset(s):
-                    print(format_alias(alias))
+            found = None
+            for song_id in bits_to_ids(songs.bits):
+                aliases = reverse_index.get(song_id, ())
+                found = set(aliases) if found is None else \
+                    found.intersection(aliases)
+                if not found:
+                    break
+            found = (found or set()) - set(others)
+            for alias in others:
+                if songs.issubset(evaluator.evaluate(alias)):
+                    found.add(alias)
+            found.discard(args.pattern.strip(' \'"'))
+    for alias in collectionsmanager.c:
+        if alias in found:
+            print(format_alias(alias))
 
 
 def add_songs(args):
@@ -149,7 +195,8 @@ def remove_songs(args):
 
 def edit(args):
     editor = os.environ.get('VISUAL') or os.environ.get('EDITOR', 'nano')
-    subprocess.call(shlex.split(editor) + [collectionsmanager.path])
+    with stats.timer('subprocess.editor'):
+        subprocess.call(shlex.split(editor) + [collectionsmanager.path])
     check(args)
 
 
@@ -164,6 +211,8 @@ def setup_args(superparser):
     listsongs_p.add_argument('-f', nargs='?', const='')
     listsongs_p.add_argument('--p', action='store_true')
     listsongs_p.add_argument('--np', action='store_true')
+    listsongs_p.add_argument('--profile', action='store_true')
+    listsongs_p.add_argument('--json', action='store_true')
     listsongs_p.set_defaults(func=ls)
 
     show_p = subparsers.add_parser('show', priority='-')
@@ -189,5 +238,5 @@ def setup_args(superparser):
     check_p.set_defaults(func=check)
 
     edit_p = subparsers.add_parser('edit', priority='-')
-    edit_p.set_defaults(func=edit)
+    edit_p.set_defaults(func=edit, local=True)
 
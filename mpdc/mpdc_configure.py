@@ -67,7 +67,7 @@ def change_default_profile(profile):
 # --------------------------------
 
 def setup_args(superparser):
-    superparser.set_defaults(func=configure)
+    superparser.set_defaults(func=configure, local=True)
     superparser.add_argument('--switch', type=int, action='store')
 
 
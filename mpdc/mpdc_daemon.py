@@ -0,0 +1,54 @@
+# coding: utf-8
+from mpdc.libs import daemon
+from mpdc.libs.utils import info, warning
+
+
+# --------------------------------
+# Program functions
+# --------------------------------
+
+def start(args):
+    path = daemon.socket_path()
+    connection = daemon.connect(path)
+    if connection is not None:
+        connection.close()
+        warning('The daemon is already running')
+        return
+    info('Listening on ' + path)
+    if args.background:
+        daemon.detach()
+    daemon.serve(path)
+
+
+def stop(args):
+    if daemon.stop():
+        info('The daemon has been stopped')
+    else:
+        warning('The daemon is not running')
+
+
+def status(args):
+    connection = daemon.connect()
+    if connection is None:
+        info('The daemon is not running')
+    else:
+        connection.close()
+        info('The daemon is running, socket: ' + daemon.socket_path())
+
+
+# --------------------------------
+# Commands parser
+# --------------------------------
+
+def setup_args(superparser):
+    subparsers = superparser.add_subparsers()
+
+    start_p = subparsers.add_parser('start', priority='-')
+    start_p.add_argument('-b', '--background', action='store_true')
+    start_p.set_defaults(func=start, local=True)
+
+    stop_p = subparsers.add_parser('stop', priority='-')
+    stop_p.set_defaults(func=stop, local=True)
+
+    status_p = subparsers.add_parser('status', priority='-')
+    status_p.set_defaults(func=status, local=True)
@@ -14,7 +14,7 @@ from mpdc.libs.parser import parser
 
 def update(args):
     mpd.mpdclient.update()
-    mpd.update_cache()
+    mpd.update_cache(full=args.full)
     cache.write('playlists', mpd.get_stored_playlists_info())
     collectionsmanager.feed(force=True)
     collectionsmanager.update_cache()
@@ -22,9 +22,8 @@ def update(args):
 
 def check(args):
     songs = []
-    song_tags_dict = mpd.get_all_songs_tags()
     for song in parser.parse(' '.join(args.collection)):
-        tags = song_tags_dict[song]
+        tags = dict(zip(mpd.main_tags, mpd.get_tags(song, mpd.main_tags)))
         missing_tags = [tag for tag, value in tags.items() if not value]
         if missing_tags:
             warning(colorize(song, colors[0]))
@@ -42,7 +41,7 @@ def check(args):
                                                                tags['title'],
                                                                tags['track']]),
                                                      colors[1 % len(colors)]))
-            # necessary because MPDHelper's get_all_songs_tags falls back
+            # necessary because MPDHelper's get_tag falls back
             # to artist if albumartist is empty, while it's find_multiple
             # (mpdclient.find in fact) does not
             # not a solution really, so FIXME
@@ -152,6 +151,7 @@ def setup_args(superparser):
     subparsers = superparser.add_subparsers()
 
     update_p = subparsers.add_parser('update', priority='-')
+    update_p.add_argument('--full', action='store_true')
     update_p.set_defaults(func=update)
 
     check_p = subparsers.add_parser('check', priority='-')
@@ -1,14 +1,185 @@
+import mpd
 
-import subprocess
+from mpdc.initialize import mpd as mpdhelper
+from mpdc.libs.utils import warning
+
+
+# --------------------------------
+# mpc-like commands
+# --------------------------------
+
+# mpc commands are translated into MPD protocol commands and sent over the
+# connection already opened by MPDHelper, positions are 1-based like in mpc
+
+def format_song(song):
+    if 'title' in song:
+        return '{} - {}'.format(mpdhelper.clear_tag(song.get('artist', '')),
+                                mpdhelper.clear_tag(song['title']))
+    return song.get('file', '')
+
+
+def toggle_option(name):
+    def command(client, state=None):
+        if state is None:
+            state = '0' if client.status().get(name) == '1' else '1'
+        else:
+            state = '1' if state in ('on', '1') else '0'
+        getattr(client, name)(state)
+    return command
+
+
+def toggle(client):
+    if client.status().get('state') == 'play':
+        client.pause(1)
+    else:
+        client.play()
+
+
+def play(client, position=None):
+    if position is None:
+        client.play()
+    else:
+        client.play(int(position) - 1)
+
+
+def volume(client, value=None):
+    if value is None:
+        print('volume: {}%'.format(client.status().get('volume', 'n/a')))
+    elif value[0] in '+-':
+        current = int(client.status().get('volume', 0))
+        client.setvol(max(0, min(100, current + int(value))))
+    else:
+        client.setvol(int(value))
+
+
+def delete(client, *positions):
+    # positions and a-b ranges like mpc, 0 is the current song
+    deleted = set()
+    for position in positions or ('0',):
+        start, _, end = position.partition('-')
+        start = int(start)
+        end = int(end) if end else start
+        if start == 0:
+            current = client.status().get('song')
+            if current is None:
+                continue
+            start = end = int(current) + 1
+        deleted.update(range(start, end + 1))
+    mpdhelper.command_list('delete', ((position - 1,) for position
+                                      in sorted(deleted, reverse=True)
+                                      if position > 0))
+
+
+def move(client, source, destination):
+    client.move(int(source) - 1, int(destination) - 1)
+
+
+def current(client):
+    song = client.currentsong()
+    if song:
+        print(format_song(song))
+
+
+def status(client):
+    current(client)
+    status = client.status()
+    print('volume: {volume}%   repeat: {repeat}   random: {random}   '
+          'single: {single}   consume: {consume}'.
+          format(**{key: status.get(key, 'n/a') for key in
+                    ('volume', 'repeat', 'random', 'single', 'consume')}))
+
+
+def playlist(client, name=None):
+    songs = client.listplaylistinfo(name) if name else client.playlistinfo()
+    for song in songs:
+        print(format_song(song))
+
+
+def outputs(client):
+    for output in client.outputs():
+        state = 'enabled' if output['outputenabled'] == '1' else 'disabled'
+        print('Output {} ({}) is {}'.format(int(output['outputid']) + 1,
+                                            output['outputname'], state))
+
+
+def enable_output(enable):
+    def command(client, *numbers):
+        for number in numbers:
+            if enable:
+                client.enableoutput(int(number) - 1)
+            else:
+                client.disableoutput(int(number) - 1)
+    return command
+
+
+commands = {
+    'play': play,
+    'toggle': toggle,
+    'prev': lambda client: client.previous(),
+    'volume': volume,
+    'random': toggle_option('random'),
+    'repeat': toggle_option('repeat'),
+    'single': toggle_option('single'),
+    'consume': toggle_option('consume'),
+    'del': delete,
+    'move': move,
+    'crop': lambda client: mpdhelper.crop(),
+    'current': current,
+    'status': status,
+    'playlist': playlist,
+    'lsplaylists': lambda client: print('\n'.join(
+                                        mpdhelper.get_stored_playlists())),
+    'rm': lambda client, name: client.rm(name),
+    'outputs': outputs,
+    'enable': enable_output(True),
+    'disable': enable_output(False),
+    'insert': lambda client, *songs: mpdhelper.insert(list(songs)),
+}
+
+
+def print_result(result):
+    if isinstance(result, dict):
+        for key, value in result.items():
+            print('{}: {}'.format(key, value))
+    elif isinstance(result, (list, tuple)):
+        for item in result:
+            print_result(item)
+    elif result is not None:
+        print(result)
+
+
+# commands which only read the state of MPD, after the others the cached
+# queue and current song are dropped since the idle watcher may not have
+# reported the change yet
+read_commands = ('current', 'status', 'playlist', 'lsplaylists', 'outputs')
+
+# commands which would change the state of the shared connection
+connection_commands = ('close', 'idle', 'noidle', 'command_list_begin',
+                       'command_list_ok_begin', 'command_list_end')
+
+
+def protocol_commands(client):
+    # the MPD commands this client is allowed to run
+    return [name for name in client.commands()
+            if name not in connection_commands and hasattr(client, name)]
 
-from mpdc.initialize import mpd
 
 def mpc(args):
+    name, arguments = args.mpc_args[0], args.mpc_args[1:]
+    client = mpdhelper.mpdclient
     try:
-        output = subprocess.check_output(mpd.mpc_c + args.mpc_args)
-        print(output.decode().strip())
-    except subprocess.CalledProcessError:
-        pass
+        if name in commands:
+            commands[name](client, *arguments)
+        elif name in protocol_commands(client):
+            # other commands are sent as-is to MPD
+            print_result(getattr(client, name)(*arguments))
+        else:
+            warning('Command [{}] does not exist'.format(name))
+    except (mpd.CommandError, TypeError, ValueError) as e:
+        warning('Error while executing [{}]: {}'.format(name, e))
+    finally:
+        if name not in read_commands:
+            mpdhelper.invalidate(('playlist', 'player'))
 
 # --------------------------------
 # Commands parser
@@ -17,4 +188,3 @@ def mpc(args):
 def setup_args(superparser, parents=()):
     superparser.set_defaults(func=mpc)
     superparser.add_argument('mpc_args', nargs='+')
-
@@ -39,16 +39,11 @@ def remove(args):
 
 def keep(args):
     songs = parser.parse(args.collection)
-    remove_songs = [s for s in mpd.get_playlist_songs() if s not in songs]
-    if remove_songs:
-        mpd.remove(remove_songs)
+    mpd.replace([s for s in mpd.get_playlist_songs() if s in songs])
 
 
 def replace(args):
-    songs = list(parser.parse(args.collection))
-    mpd.clear()
-    if songs:
-        mpd.add(songs)
+    mpd.replace(parser.parse(args.collection))
 
 
 def play(args):
@@ -22,5 +22,5 @@ setup(
               'mpdc = mpdc.mpdc_cli:main',
           ]
     },
-    install_requires=['ply >= 3.4', 'python-mpd2 >= 0.4.0']
+    install_requires=['python-mpd2 >= 1.0.0']
 )